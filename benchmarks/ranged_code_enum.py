@@ -0,0 +1,71 @@
+# The MIT License
+#
+# Copyright (c) 2017 Eugene Chekanskiy, echekanskiy@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Microbenchmark of 'RangedCodeEnum.from_code' against previous linear lookup. Does not require Hyper-V or pythonnet:
+
+  python benchmarks/ranged_code_enum.py
+"""
+import os
+import sys
+import timeit
+from collections.abc import Iterable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from hvapi.clr.types import ComputerSystem_EnabledState, Msvm_ConcreteJob_JobState, \
+  VSMS_ModifyResourceSettings_ReturnCode  # noqa: E402
+
+
+def linear_from_code(cls, value):
+  for enum_item in cls:
+    enum_val = enum_item.value
+    if isinstance(enum_val, Iterable):
+      if len(enum_val) == 1:
+        if enum_val[0] == value:
+          return enum_item
+      elif enum_val[0] <= value <= enum_val[1]:
+        return enum_item
+    elif enum_val == value:
+      return enum_item
+
+
+CASES = (
+  ("EnabledState exact", ComputerSystem_EnabledState, 2),
+  ("EnabledState last member", ComputerSystem_EnabledState, 32777),
+  ("JobState exact", Msvm_ConcreteJob_JobState, 7),
+  ("JobState vendor range", Msvm_ConcreteJob_JobState, 40000),
+  ("ModifyResourceSettings job started", VSMS_ModifyResourceSettings_ReturnCode, 4096),
+  ("ModifyResourceSettings reserved range", VSMS_ModifyResourceSettings_ReturnCode, 5000),
+)
+
+
+def main(number=200000):
+  print("%-40s %12s %12s %8s" % ("case", "linear, us", "table, us", "speedup"))
+  for name, cls, code in CASES:
+    assert linear_from_code(cls, code) is cls.from_code(code), name
+    linear = timeit.timeit(lambda: linear_from_code(cls, code), number=number) / number * 1e6
+    table = timeit.timeit(lambda: cls.from_code(code), number=number) / number * 1e6
+    print("%-40s %12.3f %12.3f %7.1fx" % (name, linear, table, linear / table))
+
+
+if __name__ == '__main__':
+  main()
@@ -66,8 +66,8 @@ default_configuration = {
 host = HypervHost()
 switch = host.switch_by_name("internal")
 for name, ip in machines:
-  vm = host.create_machine(name, default_configuration)
-  adapter = vm.add_adapter()
+  vm = host.create_machine(name, default_configuration, adapters=[{"ElementName": "Network Adapter"}])
+  adapter = vm.network_adapters[0]
   adapter.connect(switch)
   adapter.guest_settings().set_ip_settings(False, [ip], ["255.255.255.0"], ["192.168.55.1"], ["8.8.8.8"])
   vm.add_vhd_disk(clone_disk(original_disk))
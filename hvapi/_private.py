@@ -19,81 +19,687 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
+import logging
+import re
+import threading
 import time
+from concurrent.futures import CancelledError, Future
+from typing import Callable
 
+from hvapi.clr.traversal import DefaultSettingsPath, TraversalSession, wql_literal
+from hvapi.clr.events import EventDispatcher, EventSource, WqlEventSource
 from hvapi.clr.types import Msvm_ConcreteJob_JobState, VSMS_ModifyResourceSettings_ReturnCode, \
-  VSMS_ModifySystemSettings_ReturnCode, VSMS_AddResourceSettings_ReturnCode
+  VSMS_ModifySystemSettings_ReturnCode, VSMS_AddResourceSettings_ReturnCode, VSMS_RemoveResourceSettings_ReturnCode, \
+  ResourceSubType, ComputerSystem_EnabledState
 from hvapi.clr.base import JobException, ManagementObject
-from hvapi.clr.invoke import evaluate_invocation_result
+from hvapi.clr.imports import COMException, ManagementException, ManagementStatus
+from hvapi.clr.invoke import DEFAULT_JOB_TIMEOUT, evaluate_invocation_result
+from hvapi.clr.scope import ScopeBound
+from hvapi.clr.serialization import embedded_instances
+from hvapi.types import NotFoundException
+from hvapi.wait import Backoff, CancellationToken, WaitTimeoutError, wait_until
+
+
+# RPC_S_SERVER_UNAVAILABLE, RPC_S_CALL_FAILED, RPC_E_DISCONNECTED
+CONNECTION_HRESULTS = (0x800706BA, 0x800706BE, 0x80010108)
+
+
+def is_connection_error(error: Exception) -> bool:
+  """
+  Checks if given exception means that connection to WMI provider was lost.
+
+  :param error: exception raised by WMI call
+  :return: ``True`` if exception caused by broken connection
+  """
+  if isinstance(error, COMException):
+    # 'HResult' is signed 32-bit integer
+    return error.HResult & 0xFFFFFFFF in CONNECTION_HRESULTS
+  if isinstance(error, ManagementException):
+    return error.ErrorCode in (ManagementStatus.TransportFailure, ManagementStatus.ShuttingDown)
+  return False
+
+
+def path_key(path, name) -> str:
+  """
+  Returns value of key property from object path, so key of wrapped object is known without loading its properties.
+
+  :param path: 'ManagementPath' of object or path string, e.g. value of reference property
+  :param name: key property name
+  :return: key value or ``None`` if path has no such key
+  """
+  if not isinstance(path, str):
+    path = path.RelativePath
+  match = re.search(r'[.,]%s="((?:[^"\\]|\\.)*)"' % re.escape(name), path)
+  if match:
+    return re.sub(r'\\(.)', r'\1', match.group(1))
 
 
 class MOWrapper(ManagementObject):
   def __init__(self, mo: ManagementObject, parent: 'MOWrapper' = None):
+    # scope must be set before path, otherwise wrapper is bound to default scope with its own connection
+    self.Scope = mo.Scope
     self.Path = mo.Path
     self.check_class(self.MO_CLS)
     self.parent = parent
 
+  @property
+  def services(self) -> 'ServiceLocator':
+    return ServiceLocator.for_scope(self.Scope)
+
+  @property
+  def templates(self) -> 'SettingsTemplates':
+    return SettingsTemplates.for_scope(self.Scope)
+
+
+class JobFuture(Future):
+  """
+  Future of one 'Msvm_ConcreteJob' or 'Msvm_StorageJob' tracked by 'JobWaiter'. Result is last job record, failed
+  jobs raise 'JobException'. ``properties`` is last known record of job.
+  """
+  # waiter is woken by completion callback, polls just guard against missed wakeups
+  WAIT_BACKOFF = Backoff(initial=1, maximum=5)
+
+  def __init__(self, class_name, instance_id):
+    super().__init__()
+    self.class_name = class_name
+    self.instance_id = instance_id
+    self.properties = None
+    self._progress_callbacks = []
+
+  def wait(self, timeout=DEFAULT_JOB_TIMEOUT, token: CancellationToken = None):
+    """
+    Waits for job completion. Job is not tracked anymore if wait times out or is cancelled.
+
+    :param timeout: seconds to wait, ``None`` to wait forever
+    :param token: cancellation token
+    :return: last job record, 'JobException' is raised if job failed
+    """
+    wakeup = threading.Event()
+    self.add_done_callback(lambda _future: wakeup.set())
+    try:
+      wait_until(self.done, bool, timeout, self.WAIT_BACKOFF, token, wakeup, "job %s" % self.instance_id)
+    except (WaitTimeoutError, CancelledError):
+      self.cancel()
+      raise
+    return self.result()
+
+  @property
+  def percent_complete(self) -> int:
+    return self.properties.PercentComplete if self.properties is not None else 0
+
+  def add_progress_callback(self, fn: Callable[['JobFuture', int], None]):
+    """
+    Registers callback that is called with future and percent of completion every time job progress changes.
+    """
+    self._progress_callbacks.append(fn)
+
+  def _update(self, record) -> bool:
+    previous, self.properties = self.properties, record
+    if previous is not None and previous.PercentComplete == record.PercentComplete:
+      return previous.JobState != record.JobState
+    for callback in self._progress_callbacks:
+      try:
+        callback(self, record.PercentComplete)
+      except Exception:
+        JobWaiter.LOG.exception("Progress callback of job '%s' failed", self.instance_id)
+    return True
+
+
+class JobWaiter(ScopeBound):
+  """
+  Tracks all outstanding jobs of scope. Jobs are refreshed by one projected query per job class per tick, interval
+  between ticks grows while nothing changes and is reset on any progress.
+  """
+  LOG = logging.getLogger('%s.%s' % (__module__, __qualname__))
+  FIELDS = ('InstanceID', 'JobState', 'ErrorCode', 'PercentComplete', 'JobStatus', 'ErrorDescription')
+  FINISHED_STATES = (Msvm_ConcreteJob_JobState.Completed, Msvm_ConcreteJob_JobState.Terminated,
+                     Msvm_ConcreteJob_JobState.Killed, Msvm_ConcreteJob_JobState.Exception)
+  BACKOFF = Backoff(initial=0.1, maximum=2, factor=1.5, jitter=0.1)
+
+  def __init__(self, scope):
+    super().__init__(scope)
+    self.queries = 0
+    self._pending = {}
+    self._lock = threading.Lock()
+    self._wakeup = threading.Event()
+    self._thread = None
+
+  @property
+  def pending(self) -> int:
+    with self._lock:
+      return len(self._pending)
+
+  def submit(self, job: ManagementObject) -> JobFuture:
+    """
+    Starts tracking given job.
+
+    :param job: 'Msvm_ConcreteJob' or 'Msvm_StorageJob' object
+    :return: future of job
+    """
+    future = JobFuture(job.Path.ClassName, job.Properties['InstanceID'].Value)
+    with self._lock:
+      self._pending[future.instance_id] = future
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._run, daemon=True, name="hvapi-job-waiter")
+        self._thread.start()
+    self._wakeup.set()
+    return future
+
+  def _run(self):
+    delays = self.BACKOFF.delays()
+    while True:
+      with self._lock:
+        for instance_id in [_id for _id, future in self._pending.items() if future.cancelled()]:
+          del self._pending[instance_id]
+        if not self._pending:
+          self._thread = None
+          return
+        by_class = {}
+        for future in self._pending.values():
+          by_class.setdefault(future.class_name, []).append(future)
+      changed = False
+      for class_name, futures in by_class.items():
+        changed = self._refresh(class_name, futures) or changed
+      if changed:
+        delays = self.BACKOFF.delays()
+      if self._wakeup.wait(next(delays)):
+        self._wakeup.clear()
+        delays = self.BACKOFF.delays()
+
+  def _refresh(self, class_name, futures) -> bool:
+    where = ' OR '.join('InstanceID = %s' % wql_literal(future.instance_id) for future in futures)
+    try:
+      self.queries += 1
+      records = {record.InstanceID: record for record in self.scope.iter_records(class_name, self.FIELDS, where)}
+    except Exception as e:
+      if not is_connection_error(e):
+        self.LOG.debug("Failed to refresh jobs of class '%s': %s", class_name, e)
+        return False
+      for future in futures:
+        self._finish(future, exception=e)
+      return True
+    changed = False
+    for future in futures:
+      record = records.get(future.instance_id)
+      if record is None:
+        self._finish(future, exception=NotFoundException("Job '%s' disappeared before completion" %
+                                                         future.instance_id))
+        changed = True
+        continue
+      changed = future._update(record) or changed
+      job_state = Msvm_ConcreteJob_JobState.from_code(record.JobState)
+      if job_state in self.FINISHED_STATES:
+        if job_state == Msvm_ConcreteJob_JobState.Completed:
+          self._finish(future, result=record)
+        else:
+          self._finish(future, exception=JobException(future))
+    return changed
+
+  def _finish(self, future: JobFuture, result=None, exception=None):
+    with self._lock:
+      self._pending.pop(future.instance_id, None)
+    if not future.set_running_or_notify_cancel():
+      return
+    if exception is not None:
+      future.set_exception(exception)
+    else:
+      future.set_result(result)
+
 
 class JobWrapper(MOWrapper):
   MO_CLS = ('Msvm_ConcreteJob', 'Msvm_StorageJob')
 
-  def wait(self):
-    job_state = Msvm_ConcreteJob_JobState.from_code(self.properties['JobState'])
-    while job_state not in [Msvm_ConcreteJob_JobState.Completed, Msvm_ConcreteJob_JobState.Terminated,
-                            Msvm_ConcreteJob_JobState.Killed, Msvm_ConcreteJob_JobState.Exception]:
-      job_state = Msvm_ConcreteJob_JobState.from_code(self.properties['JobState'])
-      self.reload()
-      time.sleep(.1)
-    if job_state != Msvm_ConcreteJob_JobState.Completed:
-      raise JobException(self)
+  def submit(self) -> JobFuture:
+    """
+    Starts tracking of job without waiting for it.
+    """
+    return JobWaiter.for_scope(self.Scope).submit(self)
+
+  def wait(self, timeout=DEFAULT_JOB_TIMEOUT, token: CancellationToken = None):
+    """
+    Waits for job completion, raises 'JobException' if job failed.
+    """
+    return self.submit().wait(timeout, token)
+
+
+class ServiceWrapper(MOWrapper):
+  """
+  Base class for singleton services. Services and templates are cached by 'ServiceLocator' and 'SettingsTemplates', so
+  connection errors during method invocation must drop them to let them be resolved again.
+
+  Methods may add or remove objects, so active 'TraversalSession' is invalidated after invocation, unless method is
+  listed in ``HIERARCHY_PRESERVING_METHODS``. Such methods only change properties of existing objects.
+  """
+  HIERARCHY_PRESERVING_METHODS = frozenset()
+
+  def invoke(self, method_name, **kwargs):
+    try:
+      return super().invoke(method_name, **kwargs)
+    except Exception as e:
+      if is_connection_error(e):
+        self.services.invalidate()
+        self.templates.invalidate()
+      raise
+    finally:
+      if method_name not in self.HIERARCHY_PRESERVING_METHODS:
+        TraversalSession.invalidate_current()
 
+  async def invoke_async(self, method_name, **kwargs):
+    try:
+      return await super().invoke_async(method_name, **kwargs)
+    except Exception as e:
+      if is_connection_error(e):
+        self.services.invalidate()
+        self.templates.invalidate()
+      raise
+    finally:
+      if method_name not in self.HIERARCHY_PRESERVING_METHODS:
+        TraversalSession.invalidate_current()
 
-class VirtualSystemManagementService(MOWrapper):
+
+class VirtualSystemManagementService(ServiceWrapper):
+  """
+  All methods wait for started job by default, up to ``timeout`` seconds or without limit if it is ``None``. With
+  ``wait=False`` they return 'InvocationFuture' right after invocation, so changes of many machines can be pipelined
+  and joined later.
+  """
   MO_CLS = 'Msvm_VirtualSystemManagementService'
+  HIERARCHY_PRESERVING_METHODS = frozenset(("ModifyResourceSettings", "ModifySystemSettings",
+                                            "SetGuestNetworkAdapterConfiguration"))
 
-  def SetGuestNetworkAdapterConfiguration(self, ComputerSystem, *args):
+  def SetGuestNetworkAdapterConfiguration(self, ComputerSystem, *args, wait=True, timeout=DEFAULT_JOB_TIMEOUT):
     out_objects = self.invoke("SetGuestNetworkAdapterConfiguration", ComputerSystem=ComputerSystem,
                               NetworkConfiguration=args)
     return evaluate_invocation_result(
       out_objects,
       VSMS_ModifyResourceSettings_ReturnCode,
       VSMS_ModifyResourceSettings_ReturnCode.Completed_with_No_Error,
-      VSMS_ModifyResourceSettings_ReturnCode.Method_Parameters_Checked_Job_Started
+      VSMS_ModifyResourceSettings_ReturnCode.Method_Parameters_Checked_Job_Started,
+      wait,
+      timeout
     )
 
-  def ModifyResourceSettings(self, *args):
+  def ModifyResourceSettings(self, *args, wait=True, timeout=DEFAULT_JOB_TIMEOUT):
     out_objects = self.invoke("ModifyResourceSettings", ResourceSettings=args)
     return evaluate_invocation_result(
       out_objects,
       VSMS_ModifyResourceSettings_ReturnCode,
       VSMS_ModifyResourceSettings_ReturnCode.Completed_with_No_Error,
-      VSMS_ModifyResourceSettings_ReturnCode.Method_Parameters_Checked_Job_Started
+      VSMS_ModifyResourceSettings_ReturnCode.Method_Parameters_Checked_Job_Started,
+      wait,
+      timeout
     )
 
-  def ModifySystemSettings(self, SystemSettings):
+  def ModifySystemSettings(self, SystemSettings, wait=True, timeout=DEFAULT_JOB_TIMEOUT):
     out_objects = self.invoke("ModifySystemSettings", SystemSettings=SystemSettings)
     return evaluate_invocation_result(
       out_objects,
       VSMS_ModifySystemSettings_ReturnCode,
       VSMS_ModifySystemSettings_ReturnCode.Completed_with_No_Error,
-      VSMS_ModifySystemSettings_ReturnCode.Method_Parameters_Checked_Job_Started
+      VSMS_ModifySystemSettings_ReturnCode.Method_Parameters_Checked_Job_Started,
+      wait,
+      timeout
     )
 
-  def AddResourceSettings(self, AffectedConfiguration, *args):
+  def AddResourceSettings(self, AffectedConfiguration, *args, wait=True, timeout=DEFAULT_JOB_TIMEOUT):
     out_objects = self.invoke("AddResourceSettings", AffectedConfiguration=AffectedConfiguration, ResourceSettings=args)
     return evaluate_invocation_result(
       out_objects,
       VSMS_AddResourceSettings_ReturnCode,
       VSMS_AddResourceSettings_ReturnCode.Completed_with_No_Error,
-      VSMS_AddResourceSettings_ReturnCode.Method_Parameters_Checked_Job_Started
+      VSMS_AddResourceSettings_ReturnCode.Method_Parameters_Checked_Job_Started,
+      wait,
+      timeout
+    )
+
+  def RemoveResourceSettings(self, *args, wait=True, timeout=DEFAULT_JOB_TIMEOUT):
+    out_objects = self.invoke("RemoveResourceSettings", ResourceSettings=args)
+    return evaluate_invocation_result(
+      out_objects,
+      VSMS_RemoveResourceSettings_ReturnCode,
+      VSMS_RemoveResourceSettings_ReturnCode.Completed_with_No_Error,
+      VSMS_RemoveResourceSettings_ReturnCode.Method_Parameters_Checked_Job_Started,
+      wait,
+      timeout
     )
 
-  def DefineSystem(self, SystemSettings, ResourceSettings=[], ReferenceConfiguration=None):
+  def DefineSystem(self, SystemSettings, ResourceSettings=[], ReferenceConfiguration=None, wait=True,
+                   timeout=DEFAULT_JOB_TIMEOUT):
     out_objects = self.invoke("DefineSystem", SystemSettings=SystemSettings, ResourceSettings=ResourceSettings,
                               ReferenceConfiguration=ReferenceConfiguration)
     return evaluate_invocation_result(
       out_objects,
       VSMS_AddResourceSettings_ReturnCode,
       VSMS_AddResourceSettings_ReturnCode.Completed_with_No_Error,
-      VSMS_AddResourceSettings_ReturnCode.Method_Parameters_Checked_Job_Started
+      VSMS_AddResourceSettings_ReturnCode.Method_Parameters_Checked_Job_Started,
+      wait,
+      timeout
     )
+
+
+class ImageManagementService(ServiceWrapper):
+  MO_CLS = 'Msvm_ImageManagementService'
+
+
+class VirtualSystemSnapshotService(ServiceWrapper):
+  MO_CLS = 'Msvm_VirtualSystemSnapshotService'
+
+
+class ServiceLocator(ScopeBound):
+  """
+  Resolves singleton services of scope once and reuses them. Services are resolved again only after scope reconnection
+  or connection error during service method invocation.
+  """
+
+  def __init__(self, scope):
+    super().__init__(scope)
+    self._services = {}
+    self._lock = threading.Lock()
+
+  def get(self, service_cls):
+    """
+    Returns cached instance of given service wrapper class, resolves it if needed.
+
+    :param service_cls: subclass of 'ServiceWrapper'
+    :return: service instance
+    """
+    with self._lock:
+      service = self._services.get(service_cls.MO_CLS)
+      if service is None:
+        service_object = self.scope.query_one('SELECT * FROM %s' % service_cls.MO_CLS)
+        if service_object is None:
+          raise NotFoundException("No service '%s' in scope '%s'" % (service_cls.MO_CLS, self.scope.Path))
+        service = service_cls(service_object)
+        self._services[service_cls.MO_CLS] = service
+      return service
+
+  @property
+  def management_service(self) -> VirtualSystemManagementService:
+    return self.get(VirtualSystemManagementService)
+
+  @property
+  def image_management_service(self) -> ImageManagementService:
+    return self.get(ImageManagementService)
+
+  @property
+  def snapshot_service(self) -> VirtualSystemSnapshotService:
+    return self.get(VirtualSystemSnapshotService)
+
+  def invalidate(self):
+    with self._lock:
+      self._services.clear()
+
+
+class SettingsTemplates(ScopeBound):
+  """
+  Caches default allocation settings of primordial resource pools by their 'ResourceSubType'. Every 'get' call returns
+  fresh clone of cached template, so it can be modified freely. Templates are dropped on connection errors, lock is
+  not held while template is queried, so slow query does not block lookups of other templates.
+  """
+
+  def __init__(self, scope):
+    super().__init__(scope)
+    self._templates = {}
+    self._lock = threading.Lock()
+
+  def get(self, resource_sub_type: ResourceSubType) -> ManagementObject:
+    """
+    Returns clone of default settings for given resource sub type.
+
+    :param resource_sub_type: resource sub type of primordial resource pool
+    :return: default allocation settings object
+    """
+    resource_sub_type = ResourceSubType(resource_sub_type)
+    with self._lock:
+      template = self._templates.get(resource_sub_type)
+    if template is None:
+      try:
+        template = self._load(resource_sub_type)
+      except Exception as e:
+        if is_connection_error(e):
+          self.invalidate()
+        raise
+      with self._lock:
+        # concurrent lookup may have loaded it first
+        template = self._templates.setdefault(resource_sub_type, template)
+    return template.clone()
+
+  def _load(self, resource_sub_type: ResourceSubType) -> ManagementObject:
+    resource_pool = self.scope.query_one(
+      "SELECT * FROM Msvm_ResourcePool WHERE ResourceSubType = '%s' AND Primordial = True" % resource_sub_type.value)
+    if resource_pool is None:
+      raise NotFoundException("No primordial resource pool for '%s'" % resource_sub_type.value)
+    template = resource_pool.get_child(DefaultSettingsPath)
+    # serialized once, clones inherit text and patch only changed properties
+    embedded_instances.serialize(template)
+    return template
+
+  def invalidate(self):
+    with self._lock:
+      self._templates.clear()
+
+
+class ComputerSystemEvents(ScopeBound):
+  """
+  Host-level dispatcher of virtual machines creation, modification and deletion events. One event subscription is
+  shared by all waiters and state tables of scope, waiters are woken as soon as 'EnabledState' of their machine
+  changes. Polling is used as fallback for missed events and when events are not available at all.
+  """
+  LOG = logging.getLogger('%s.%s' % (__module__, __qualname__))
+  EVENT_WITHIN = 1
+  EVENT_QUERY = "SELECT * FROM __InstanceOperationEvent WITHIN %s WHERE TargetInstance ISA 'Msvm_ComputerSystem' " \
+                "AND TargetInstance.Caption = 'Virtual Machine'"
+  EVENT_PROPERTIES = ('Name', 'ElementName', 'EnabledState')
+  # poll interval when events are delivered, just in case some event was lost
+  EVENT_POLL_INTERVAL = 5
+  # poll interval when events are not available
+  POLL_INTERVAL = 1
+  EVENT_BACKOFF = Backoff(initial=POLL_INTERVAL, maximum=EVENT_POLL_INTERVAL, factor=2, jitter=0.1)
+  POLL_BACKOFF = Backoff(initial=0.1, maximum=POLL_INTERVAL, factor=1.5, jitter=0.1)
+
+  def __init__(self, scope, source: EventSource = None):
+    super().__init__(scope)
+    self.dispatcher = EventDispatcher(source or self._default_source(), 'Name')
+
+  def _default_source(self) -> EventSource:
+    return WqlEventSource(self.scope, self.EVENT_QUERY % self.EVENT_WITHIN, self.EVENT_PROPERTIES)
+
+  def use_source(self, source: EventSource):
+    """
+    Replaces source of events, e.g. with 'ManualEventSource' in tests.
+    """
+    self.dispatcher.replace_source(source)
+
+  def wait_for_state(self, machine_id, accept: Callable[[ComputerSystem_EnabledState], bool],
+                     poll: Callable[[], ComputerSystem_EnabledState], timeout, backoff: Backoff = None,
+                     token: CancellationToken = None) -> ComputerSystem_EnabledState:
+    """
+    Waits until machine gets state accepted by ``accept`` or timeout expires. State is polled once before
+    subscribing, so machines that already are in accepted state do not start event subscription.
+
+    :param machine_id: machine 'Name'
+    :param accept: returns ``True`` if state is what we are waiting for
+    :param poll: returns actual machine state, used initially and as fallback
+    :param timeout: seconds to wait
+    :param backoff: delays between fallback polls, depends on events availability if not given
+    :param token: cancellation token
+    :return: last known machine state
+    """
+    if token is not None:
+      token.raise_if_cancelled()
+    started = time.monotonic()
+    state = poll()
+    if accept(state):
+      return state
+    if timeout is not None:
+      timeout -= time.monotonic() - started
+      if timeout <= 0:
+        return state
+
+    wake = threading.Event()
+    wake_lock = threading.Lock()
+    pending = []
+
+    def on_event(event_class, properties):
+      if event_class == '__InstanceDeletionEvent':
+        return
+      with wake_lock:
+        pending.append(ComputerSystem_EnabledState.from_code(properties['EnabledState']))
+        wake.set()
+
+    def next_state():
+      with wake_lock:
+        events_states = list(pending)
+        pending.clear()
+      if events_states:
+        accepted = [event_state for event_state in events_states if accept(event_state)]
+        return accepted[0] if accepted else events_states[-1]
+      return poll()
+
+    dispatcher = self.dispatcher
+    try:
+      subscription = dispatcher.subscribe(machine_id, on_event)
+      default_backoff = self.EVENT_BACKOFF
+    except Exception as e:
+      self.LOG.debug("Events are not available, falling back to polling: %s", e)
+      subscription = None
+      default_backoff = self.POLL_BACKOFF
+    try:
+      return wait_until(next_state, accept, timeout, backoff or default_backoff, token, wake,
+                        "machine %s state" % machine_id)
+    except WaitTimeoutError as e:
+      return e.value
+    finally:
+      if subscription is not None:
+        dispatcher.unsubscribe(subscription)
+
+  def invalidate(self):
+    self.dispatcher.stop()
+
+
+class MachineStateEntry(object):
+  """
+  Known state of one virtual machine in 'MachineStateTable'.
+  """
+  __slots__ = ('id', 'name', 'enabled_state', 'changed')
+
+  def __init__(self, machine_id, name, enabled_state: ComputerSystem_EnabledState, changed):
+    self.id = machine_id
+    self.name = name
+    self.enabled_state = enabled_state
+    self.changed = changed
+
+  def __repr__(self):
+    return "MachineStateEntry(id=%r, name=%r, enabled_state=%s, changed=%r)" % (
+      self.id, self.name, self.enabled_state, self.changed)
+
+
+class MachineStateTable(ScopeBound):
+  """
+  In-memory table of all virtual machines states of scope. Table is fed by shared 'ComputerSystemEvents' subscription
+  and is resynced by one projected bulk query every ``resync_interval`` seconds, so lost events are corrected.
+  """
+  LOG = logging.getLogger('%s.%s' % (__module__, __qualname__))
+  DEFAULT_RESYNC_INTERVAL = 60
+
+  def __init__(self, scope):
+    super().__init__(scope)
+    self.resync_interval = self.DEFAULT_RESYNC_INTERVAL
+    self._entries = {}
+    self._lock = threading.Lock()
+    self._token = None
+    self._stop = None
+    self._thread = None
+
+  @property
+  def active(self) -> bool:
+    return self._thread is not None
+
+  def start(self, resync_interval=DEFAULT_RESYNC_INTERVAL):
+    """
+    Subscribes to events, performs initial sync and starts periodic resync. Does nothing if table is already active.
+    """
+    with self._lock:
+      if self._thread is not None:
+        return
+      self.resync_interval = resync_interval
+      self._stop = threading.Event()
+      self._thread = threading.Thread(target=self._resync_loop, args=(self._stop,), daemon=True,
+                                      name="hvapi-state-table")
+    events = ComputerSystemEvents.for_scope(self.scope)
+    try:
+      self._token = events.dispatcher.subscribe(None, self._on_event)
+    except Exception as e:
+      self.LOG.debug("Events are not available, table is updated only by resync: %s", e)
+    try:
+      self.resync()
+    except Exception:
+      # table is left inactive, so it can be started again
+      self.stop()
+      raise
+    self._thread.start()
+
+  def stop(self):
+    with self._lock:
+      if self._thread is None:
+        return
+      self._stop.set()
+      self._thread = None
+      token, self._token = self._token, None
+      self._entries.clear()
+    if token is not None:
+      ComputerSystemEvents.for_scope(self.scope).dispatcher.unsubscribe(token)
+
+  def get(self, machine_id) -> MachineStateEntry:
+    with self._lock:
+      return self._entries.get(machine_id.upper())
+
+  @property
+  def entries(self) -> list:
+    with self._lock:
+      return list(self._entries.values())
+
+  def resync(self):
+    """
+    Reloads states of all machines with one projected query.
+    """
+    now = time.time()
+    entries = {}
+    for record in self.scope.iter_records('Msvm_ComputerSystem', ('Name', 'ElementName', 'EnabledState'),
+                                          "Caption = 'Virtual Machine'"):
+      machine_id = record.Name.upper()
+      enabled_state = ComputerSystem_EnabledState.from_code(record.EnabledState)
+      entries[machine_id] = MachineStateEntry(machine_id, record.ElementName, enabled_state, now)
+    with self._lock:
+      for machine_id, entry in entries.items():
+        known = self._entries.get(machine_id)
+        if known is not None and known.enabled_state == entry.enabled_state:
+          entry.changed = known.changed
+      self._entries = entries
+
+  def _on_event(self, event_class, properties):
+    machine_id = properties['Name'].upper()
+    with self._lock:
+      if event_class == '__InstanceDeletionEvent':
+        self._entries.pop(machine_id, None)
+        return
+      enabled_state = ComputerSystem_EnabledState.from_code(properties['EnabledState'])
+      entry = self._entries.get(machine_id)
+      if entry is None:
+        self._entries[machine_id] = MachineStateEntry(machine_id, properties['ElementName'], enabled_state, time.time())
+      else:
+        entry.name = properties['ElementName']
+        if entry.enabled_state != enabled_state:
+          entry.enabled_state = enabled_state
+          entry.changed = time.time()
+
+  def _resync_loop(self, stop: threading.Event):
+    while not stop.wait(self.resync_interval):
+      try:
+        ComputerSystemEvents.for_scope(self.scope).dispatcher.ensure_running()
+      except Exception as e:
+        self.LOG.debug("Failed to restart events: %s", e)
+      try:
+        self.resync()
+      except Exception as e:
+        self.LOG.debug("Failed to resync machine states: %s", e)
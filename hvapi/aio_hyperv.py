@@ -19,5 +19,325 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
-raise NotImplementedError("This module not supported at this moment")
+"""
+Asyncio API on top of synchronous ``hvapi.hyperv``. All blocking WMI calls are done on dedicated bounded executor,
+so they never occupy default executor of event loop. Waits for machine states and jobs are done by asyncio.
+"""
+import asyncio
+import ctypes
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import partial
+from typing import Any, Dict, List, Sequence
 
+from hvapi._private import ComputerSystemEvents, MachineStateTable
+from hvapi.clr.imports import ConnectionOptions
+from hvapi.clr.scope import ObjectFactory
+from hvapi.clr.types import ComputerSystem_RequestStateChange_RequestedState, ComputerSystem_EnabledState
+from hvapi.disk.vhd import VHDDisk
+from hvapi.hyperv import HypervHost, VirtualMachine, VirtualNetworkAdapter, VirtualSwitch, DeviceBuilder, \
+  DEFAULT_WAIT_OP_TIMEOUT
+from hvapi.types import VirtualMachineGeneration, VirtualMachineState
+from hvapi.wait import CancellationToken, WaitTimeoutError, wait_until_async
+
+DEFAULT_MAX_WORKERS = 4
+MACHINE_FIELDS = ('Name', 'ElementName')
+
+_COINIT_MULTITHREADED = 0x0
+_RPC_E_CHANGED_MODE = -2147417850
+
+
+def _init_com_apartment():
+  """
+  Joins executor thread to multithreaded COM apartment, so WMI objects can be used from any executor thread.
+  """
+  if sys.platform != 'win32':
+    return
+  result = ctypes.windll.ole32.CoInitializeEx(None, _COINIT_MULTITHREADED)
+  if result < 0 and result != _RPC_E_CHANGED_MODE:
+    raise ctypes.WinError(result)
+
+
+def _advance(steps, value, error):
+  """
+  Resumes generator of steps, returns next step or ``None`` when generator is exhausted. 'StopIteration' can not be
+  passed through executor future, so it is handled here.
+  """
+  try:
+    return steps.throw(error) if error is not None else steps.send(value)
+  except StopIteration:
+    return None
+
+
+class WmiExecutor(ThreadPoolExecutor):
+  """
+  Bounded executor for blocking WMI calls, every thread is initialized for multithreaded COM apartment.
+  """
+
+  def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+    super().__init__(max_workers=max_workers, thread_name_prefix="hvapi-wmi", initializer=_init_com_apartment)
+
+
+class AsyncVirtualMachine(object):
+  """
+  Asyncio counterpart of 'VirtualMachine'. Machine id and name are loaded on creation, everything else is awaitable.
+  """
+  LOG = logging.getLogger('%s.%s' % (__module__, __qualname__))
+
+  def __init__(self, host: 'AsyncHypervHost', machine: VirtualMachine, machine_id, name):
+    self.host = host
+    self.machine = machine
+    self.id = machine_id
+    self.name = name
+
+  async def state(self, timeout=DEFAULT_WAIT_OP_TIMEOUT, token: CancellationToken = None) -> VirtualMachineState:
+    """
+    Current virtual machine state, middle states like starting or stopping are waited for ``timeout`` seconds, see
+    ``VirtualMachine.get_state``.
+    """
+    table = MachineStateTable.for_scope(self.machine.Scope)
+    if table.active:
+      entry = table.get(self.id)
+      if entry is not None and entry.enabled_state.to_virtual_machine_state() != VirtualMachineState.UNDEFINED:
+        return entry.enabled_state.to_virtual_machine_state()
+    enabled_state = await self._wait_for_enabled_state(
+      lambda _state: _state.to_virtual_machine_state() != VirtualMachineState.UNDEFINED, timeout, token)
+    return enabled_state.to_virtual_machine_state()
+
+  async def start(self, timeout=DEFAULT_WAIT_OP_TIMEOUT, token: CancellationToken = None):
+    await self._change_state(ComputerSystem_RequestStateChange_RequestedState.Running, VirtualMachineState.RUNNING,
+                             timeout, token)
+
+  async def save(self, timeout=DEFAULT_WAIT_OP_TIMEOUT, token: CancellationToken = None):
+    await self._change_state(ComputerSystem_RequestStateChange_RequestedState.Saved, VirtualMachineState.SAVED,
+                             timeout, token)
+
+  async def pause(self, timeout=DEFAULT_WAIT_OP_TIMEOUT, token: CancellationToken = None):
+    await self._change_state(ComputerSystem_RequestStateChange_RequestedState.Paused, VirtualMachineState.PAUSED,
+                             timeout, token)
+
+  async def stop(self, force=False, hard=False, timeout=DEFAULT_WAIT_OP_TIMEOUT, token: CancellationToken = None):
+    """
+    Try to stop virtual machine gracefully and kill it if it is not stopped in ``timeout`` seconds, see
+    ``VirtualMachine.stop``.
+    """
+    self.LOG.debug("Stopping machine '%s'", self.id)
+    if not hard:
+      shutdown_component = await self.host.run(self.machine._get_shutdown_component)
+      if shutdown_component:
+        target_enabled_state = ComputerSystem_RequestStateChange_RequestedState.Off.to_ComputerSystem_EnabledState()
+        invocation = await self.host.run(shutdown_component.InitiateShutdown, force, "hvapi shutdown", wait=False)
+        deadline = time.monotonic() + timeout
+        try:
+          await self.host.wait_job(invocation, timeout)
+          await self._wait_for_enabled_state(lambda _state: _state == target_enabled_state,
+                                             max(deadline - time.monotonic(), 0), token)
+          self.LOG.debug("Stopped machine '%s'", self.id)
+          return
+        except WaitTimeoutError:
+          self.LOG.debug("Failed to stop machine '%s' gracefully, killing...", self.id)
+      else:
+        self.LOG.debug("Graceful stop for machine '%s' not available, killing...", self.id)
+    await self.kill(timeout, token)
+    self.LOG.debug("Stopped machine '%s'", self.id)
+
+  async def kill(self, timeout=DEFAULT_WAIT_OP_TIMEOUT, token: CancellationToken = None):
+    await self._change_state(ComputerSystem_RequestStateChange_RequestedState.Off, None, timeout, token)
+
+  async def add_adapter(self, static_mac=False, mac=None, adapter_name="Network Adapter") -> VirtualNetworkAdapter:
+    devices = self.devices().add_adapter(static_mac, mac, adapter_name)
+    await self.commit_devices(devices)
+    return devices.adapters[-1]
+
+  async def add_vhd_disk(self, vhd_disk: VHDDisk):
+    await self.commit_devices(self.devices().add_vhd_disk(vhd_disk))
+
+  def devices(self) -> DeviceBuilder:
+    """
+    Returns builder of device changes, that must be applied by 'commit_devices'.
+    """
+    return DeviceBuilder(self.machine)
+
+  async def commit_devices(self, devices: DeviceBuilder):
+    """
+    Applies changes collected by builder like ``DeviceBuilder.commit`` does, jobs are waited for without occupying any
+    thread.
+    """
+    steps = devices.commit_steps()
+    value = error = None
+    while True:
+      invocation = await self.host.run(_advance, steps, value, error)
+      if invocation is None:
+        return
+      value = error = None
+      try:
+        value = await self.host.wait_job(await self.host.run(invocation, wait=False))
+      except Exception as e:
+        error = e
+
+  async def network_adapters(self) -> List[VirtualNetworkAdapter]:
+    return await self.host.run(lambda: self.machine.network_adapters)
+
+  async def apply_properties_group(self, properties_group: Dict[str, Dict[str, Any]]):
+    return await self.host.run(self.machine.apply_properties_group, properties_group)
+
+  async def _change_state(self, requested_state: ComputerSystem_RequestStateChange_RequestedState,
+                          skip_state: VirtualMachineState, timeout, token):
+    if skip_state is not None and await self.state(timeout, token) == skip_state:
+      self.LOG.debug("Machine '%s' is already in state '%s'", self.id, skip_state)
+      return
+    target_enabled_state = requested_state.to_ComputerSystem_EnabledState()
+    invocation = await self.host.run(self.machine.RequestStateChange, requested_state, wait=False)
+    deadline = time.monotonic() + timeout
+    try:
+      await self.host.wait_job(invocation, timeout)
+      await self._wait_for_enabled_state(lambda _state: _state == target_enabled_state,
+                                         max(deadline - time.monotonic(), 0), token)
+    except WaitTimeoutError:
+      raise Exception("Failed to put machine to '%s' in %s seconds" % (target_enabled_state, timeout))
+
+  async def _wait_for_enabled_state(self, accept, timeout, token) -> ComputerSystem_EnabledState:
+    # state is polled once before subscribing, like in 'ComputerSystemEvents.wait_for_state'
+    if token is not None:
+      token.raise_if_cancelled()
+    started = time.monotonic()
+    state = await self.host.run(lambda: self.machine._enabled_state)
+    if accept(state):
+      return state
+    remaining = timeout
+    if timeout is not None:
+      remaining -= time.monotonic() - started
+      if remaining <= 0:
+        raise WaitTimeoutError("machine %s state" % self.id, timeout, state)
+
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    events_states = []
+
+    def on_event(event_class, properties):
+      if event_class == '__InstanceDeletionEvent':
+        return
+      state = ComputerSystem_EnabledState.from_code(properties['EnabledState'])
+      loop.call_soon_threadsafe(self._on_event_state, events_states, wakeup, state)
+
+    async def poll():
+      if events_states:
+        accepted = [event_state for event_state in events_states if accept(event_state)]
+        state = accepted[0] if accepted else events_states[-1]
+        events_states.clear()
+        return state
+      return await self.host.run(lambda: self.machine._enabled_state)
+
+    dispatcher = self.machine.events.dispatcher
+    try:
+      subscription = await self.host.run(dispatcher.subscribe, self.id, on_event)
+      backoff = ComputerSystemEvents.EVENT_BACKOFF
+    except Exception as e:
+      self.LOG.debug("Events are not available, falling back to polling: %s", e)
+      subscription = None
+      backoff = ComputerSystemEvents.POLL_BACKOFF
+    try:
+      return await wait_until_async(poll, accept, remaining, backoff, token, wakeup, "machine %s state" % self.id)
+    finally:
+      if subscription is not None:
+        await self.host.run(dispatcher.unsubscribe, subscription)
+
+  @staticmethod
+  def _on_event_state(events_states, wakeup: asyncio.Event, state):
+    events_states.append(state)
+    wakeup.set()
+
+
+class AsyncHypervHost(object):
+  """
+  Asyncio counterpart of 'HypervHost'. Blocking calls are done by own 'WmiExecutor' with ``max_workers`` threads,
+  unless shared ``executor`` is given.
+  """
+
+  def __init__(self, host=".", options: ConnectionOptions = None, executor: ThreadPoolExecutor = None,
+               max_workers=DEFAULT_MAX_WORKERS):
+    self.host = HypervHost(host, options)
+    self._own_executor = executor is None
+    self.executor = executor or WmiExecutor(max_workers)
+
+  async def run(self, func, *args, **kwargs):
+    """
+    Runs blocking function on executor of host.
+    """
+    return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+  async def wait_job(self, invocation: Future, timeout=None):
+    """
+    Waits for result of invocation started with ``wait=False``, without occupying any thread.
+
+    :param invocation: 'InvocationFuture' or 'JobFuture'
+    :param timeout: seconds to wait, ``None`` to wait forever
+    :return: invocation result
+    """
+    try:
+      return await asyncio.wait_for(asyncio.wrap_future(invocation), timeout)
+    except asyncio.TimeoutError:
+      raise WaitTimeoutError("job", timeout, None)
+
+  async def machines(self) -> List[AsyncVirtualMachine]:
+    """
+    Returns all machines with one executor call. Ids and names are taken from state table if host is watched,
+    otherwise from one projected query.
+    """
+    def _machines():
+      table = self.host.state_table
+      if table.active:
+        return self._from_keys((entry.id, entry.name) for entry in table.entries)
+      return self._from_keys((record.Name, record.ElementName)
+                             for record in self.host.list_machines(MACHINE_FIELDS))
+    return await self.run(_machines)
+
+  async def machine_by_name(self, name) -> AsyncVirtualMachine:
+    return await self.run(lambda: self._from_record(self.host.machine_by_name(name, MACHINE_FIELDS)))
+
+  async def machine_by_id(self, machine_id) -> AsyncVirtualMachine:
+    return await self.run(lambda: self._from_record(self.host.machine_by_id(machine_id, MACHINE_FIELDS)))
+
+  async def switches(self) -> List[VirtualSwitch]:
+    return await self.run(lambda: self.host.switches)
+
+  async def switch_by_name(self, name) -> VirtualSwitch:
+    return await self.run(self.host.switch_by_name, name)
+
+  async def create_machine(self, name, properties_group: Dict[str, Dict[str, Any]] = None,
+                           machine_generation: VirtualMachineGeneration = VirtualMachineGeneration.GEN1,
+                           adapters: Sequence[Dict[str, Any]] = None) -> AsyncVirtualMachine:
+    return await self._wrap(
+      await self.run(self.host.create_machine, name, properties_group, machine_generation, adapters))
+
+  def _from_keys(self, keys) -> List[AsyncVirtualMachine]:
+    """
+    Creates machines for (id, name) pairs, objects are bound to host scope and are not loaded until used.
+    """
+    factory = ObjectFactory.for_scope(self.host.scope)
+    return [
+      AsyncVirtualMachine(self, VirtualMachine(factory.get(HypervHost.MACHINE_PATH % machine_id)), machine_id, name)
+      for machine_id, name in keys
+    ]
+
+  def _from_record(self, record) -> AsyncVirtualMachine:
+    return self._from_keys(((record.Name, record.ElementName),))[0]
+
+  async def _wrap(self, machine: VirtualMachine) -> AsyncVirtualMachine:
+    machine_id, name = await self.run(lambda: (machine.id, machine.name))
+    return AsyncVirtualMachine(self, machine, machine_id, name)
+
+  def close(self, wait=True):
+    """
+    Shuts down own executor, shared executor is left untouched.
+    """
+    if self._own_executor:
+      self.executor.shutdown(wait=wait)
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc_val, exc_tb):
+    self.close(wait=False)
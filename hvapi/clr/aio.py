@@ -0,0 +1,91 @@
+# The MIT License
+#
+# Copyright (c) 2017 Eugene Chekanskiy, echekanskiy@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import asyncio
+from typing import Callable, List
+
+from hvapi.clr.imports import ManagementOperationObserver, ObjectReadyEventHandler, CompletedEventHandler, \
+  ManagementStatus
+
+
+class OperationException(Exception):
+  """
+  Raised when asynchronous WMI operation completed with status other than 'ManagementStatus.NoError'.
+  """
+
+  def __init__(self, status, description=None):
+    super().__init__("Operation failed with status '%s'%s" % (status, ": %s" % description if description else ""))
+    self.status = status
+
+
+def observe(start: Callable[['ManagementOperationObserver'], None], transform: Callable = None) -> asyncio.Future:
+  """
+  Starts asynchronous WMI operation and returns asyncio future that is resolved with list of objects delivered to
+  observer. Observer callbacks are called on WMI threads and only schedule completion on event loop, so no thread is
+  held while operation is in flight. Cancelling future cancels operation.
+
+  :param start: starts operation with given observer, e.g. ``lambda observer: searcher.Get(observer)``
+  :param transform: applied to every delivered object on WMI thread
+  :return: future of delivered objects
+  """
+  loop = asyncio.get_running_loop()
+  future = loop.create_future()
+  observer = ManagementOperationObserver()
+  objects = []
+
+  def on_object_ready(sender, args):
+    objects.append(transform(args.NewObject) if transform is not None else args.NewObject)
+
+  def on_completed(sender, args):
+    if args.Status == ManagementStatus.NoError:
+      loop.call_soon_threadsafe(_resolve, future, objects, None)
+    else:
+      description = None
+      if args.StatusObject is not None:
+        description = args.StatusObject.Properties['Description'].Value
+      loop.call_soon_threadsafe(_resolve, future, None, OperationException(args.Status, description))
+
+  ready_handler = ObjectReadyEventHandler(on_object_ready)
+  completed_handler = CompletedEventHandler(on_completed)
+  observer.ObjectReady += ready_handler
+  observer.Completed += completed_handler
+
+  def on_done(_future):
+    if _future.cancelled():
+      observer.Cancel()
+    observer.ObjectReady -= ready_handler
+    observer.Completed -= completed_handler
+
+  future.add_done_callback(on_done)
+  try:
+    start(observer)
+  except Exception as e:
+    future.set_exception(e)
+  return future
+
+
+def _resolve(future: asyncio.Future, result: List, exception: Exception):
+  if future.done():
+    return
+  if exception is not None:
+    future.set_exception(exception)
+  else:
+    future.set_result(result)
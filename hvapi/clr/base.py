@@ -19,20 +19,66 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
-import collections
-from typing import List, Sequence
+import threading
+from collections.abc import Iterable
+from contextlib import closing
+from itertools import islice
+from typing import List, Sequence, Iterator, Tuple
 
 from hvapi.clr.imports import Guid, CimType, String, ManagementScope, ObjectQuery, ManagementObjectSearcher, \
-  ManagementClass, ManagementException, ManagementObject, Array
-from hvapi.clr.invoke import transform_argument
-from hvapi.clr.traversal import Node, recursive_traverse
+  ManagementClass, ManagementException, ManagementObject, Array, EnumerationOptions, ConnectionOptions, TimeSpan
+from hvapi.clr.aio import observe
+from hvapi.clr.invoke import argument_converter
+from hvapi.clr.scope import ScopeBound
+from hvapi.clr.serialization import embedded_instances
+from hvapi.clr.traversal import Node, recursive_traverse, iter_traverse, first, only
 from hvapi.common import opencls
 
 
+DEFAULT_QUERY_BLOCK_SIZE = 64
+
+
 def generate_guid(fmt="B"):
   return Guid.NewGuid().ToString(fmt)
 
 
+def connection_options(timeout=None, username=None, password=None, authority=None) -> ConnectionOptions:
+  """
+  Creates 'ConnectionOptions' for 'ManagementScope'.
+
+  :param timeout: timeout of WMI operations in seconds
+  :param username: user name for remote connection, current user is used if not given
+  :param password: password for remote connection
+  :param authority: authority to be used to authenticate user, e.g. 'ntlmdomain:DOMAIN'
+  :return: connection options
+  """
+  options = ConnectionOptions()
+  options.EnablePrivileges = True
+  if timeout is not None:
+    options.Timeout = TimeSpan.FromSeconds(timeout)
+  if username is not None:
+    options.Username = username
+    options.Password = password
+  if authority is not None:
+    options.Authority = authority
+  return options
+
+
+def select_query(class_name, fields: Sequence[str] = None, where=None) -> str:
+  """
+  Builds WQL select query for given class.
+
+  :param class_name: class to select
+  :param fields: properties to select, all properties are selected if not given
+  :param where: optional query condition
+  :return: WQL query
+  """
+  query = 'SELECT %s FROM %s' % (', '.join(fields) if fields else '*', class_name)
+  if where:
+    query += ' WHERE %s' % where
+  return query
+
+
 class CimTypeTransformer(object):
   """
 
@@ -59,18 +105,154 @@ class CimTypeTransformer(object):
     raise Exception("unknown type")
 
 
+class MethodSignature(object):
+  """
+  Compiled signature of one method of one class. Holds template of input parameters that is cloned for every call and
+  precompiled converters of input and output parameters. Output converters are compiled from first result.
+  """
+  __slots__ = ('method_name', 'scope', 'template', 'inputs', 'outputs')
+
+  def __init__(self, management_object, method_name, scope):
+    self.method_name = method_name
+    self.scope = scope
+    self.template = management_object.GetMethodParameters(method_name)
+    self.inputs = tuple(self._compile(parameter) for parameter in self.template.Properties)
+    self.outputs = None
+
+  def _compile(self, _property):
+    target_class = CimTypeTransformer.target_class(_property.Type)
+    return _property.Name, _property.IsArray, target_class, argument_converter(target_class, self.scope)
+
+  def prepare(self, kwargs):
+    """
+    Returns clone of input parameters template filled with transformed arguments.
+    """
+    parameters = self.template.Clone()
+    for parameter_name, is_array, parameter_type, convert in self.inputs:
+      if parameter_name not in kwargs:
+        raise ValueError("Parameter '%s' not provided" % parameter_name)
+      value = kwargs[parameter_name]
+      if is_array:
+        if not isinstance(value, Iterable):
+          raise ValueError("Parameter '%s' must be iterable" % parameter_name)
+        array_items = [convert(item) for item in value]
+        parameter_value = Array[parameter_type](array_items) if array_items else None
+      else:
+        parameter_value = convert(value)
+      parameters.Properties[parameter_name].Value = parameter_value
+    return parameters
+
+  def transform(self, invocation_result) -> dict:
+    """
+    Transforms output parameters to dict of python values. Method without output parameters gives empty dict.
+    """
+    if invocation_result is None:
+      return {}
+    outputs = self.outputs
+    if outputs is None:
+      outputs = self.outputs = tuple(self._compile(_property) for _property in invocation_result.Properties)
+    properties = invocation_result.Properties
+    transformed_result = {}
+    for property_name, is_array, _, convert in outputs:
+      value = properties[property_name].Value
+      if value is not None:
+        value = [convert(item) for item in value] if is_array else convert(value)
+      transformed_result[property_name] = value
+    return transformed_result
+
+
+class MethodSignatures(ScopeBound):
+  """
+  Cache of compiled method signatures of scope, keyed by class and method name.
+  """
+
+  def __init__(self, scope):
+    super().__init__(scope)
+    self._signatures = {}
+    self._lock = threading.Lock()
+
+  def get(self, management_object, method_name) -> MethodSignature:
+    key = (management_object.ClassPath.ClassName, method_name)
+    signature = self._signatures.get(key)
+    if signature is None:
+      with self._lock:
+        signature = self._signatures.get(key)
+        if signature is None:
+          signature = MethodSignature(management_object, method_name, self.scope)
+          self._signatures[key] = signature
+    return signature
+
+  def invalidate(self):
+    with self._lock:
+      self._signatures.clear()
+
+
 @opencls(ManagementScope)
 class ManagementScope(object):
-  def query(self, query, parent=None) -> List['ManagementObject']:
-    result = []
-    query_obj = ObjectQuery(query)
-    searcher = ManagementObjectSearcher(self, query_obj)
-    for man_object in searcher.Get():
-      result.append(man_object)
-    return result
+  def iter_query(self, query, block_size=DEFAULT_QUERY_BLOCK_SIZE, return_immediately=True, rewindable=False,
+                 direct_read=False) -> Iterator['ManagementObject']:
+    """
+    Executes query and yields objects as soon as they arrive. Uses forward-only enumeration, so objects are not kept
+    by enumerator after they were yielded.
+
+    :param query: WQL query
+    :param block_size: number of objects that are fetched from provider at once
+    :param return_immediately: if ``True`` query is semi-synchronous and enumeration starts before query completion
+    :param rewindable: if ``True`` objects are kept by enumerator and collection can be enumerated more than once
+    :param direct_read: if ``True`` only objects of given class are returned, without derived classes
+    :return: iterator over query results
+    """
+    options = EnumerationOptions()
+    options.BlockSize = block_size
+    options.ReturnImmediately = return_immediately
+    options.Rewindable = rewindable
+    options.DirectRead = direct_read
+    searcher = ManagementObjectSearcher(self, ObjectQuery(query), options)
+    collection = searcher.Get()
+    try:
+      for man_object in collection:
+        yield man_object
+    finally:
+      collection.Dispose()
+      searcher.Dispose()
+
+  def iter_records(self, class_name, fields: Sequence[str], where=None) -> Iterator['ObjectRecord']:
+    """
+    Executes projected query and yields immutable records with selected properties. Underlying objects are disposed
+    right after record is created.
+
+    :param class_name: class to select
+    :param fields: properties to select
+    :param where: optional query condition
+    :return: iterator over records
+    """
+    record_cls = record_type(fields)
+    for man_object in self.iter_query(select_query(class_name, record_cls.FIELDS, where)):
+      try:
+        yield record_cls.from_object(man_object)
+      finally:
+        man_object.Dispose()
+
+  def query(self, query, parent=None, limit=None) -> List['ManagementObject']:
+    with closing(self.iter_query(query)) as objects:
+      return list(islice(objects, limit))
+
+  async def query_async(self, query) -> List['ManagementObject']:
+    """
+    Executes query asynchronously, objects are delivered to observer by WMI and no thread is held until query
+    completes.
+
+    :param query: WQL query
+    :return: list of objects
+    """
+    searcher = ManagementObjectSearcher(self, ObjectQuery(query))
+    try:
+      return await observe(lambda observer: searcher.Get(observer))
+    finally:
+      searcher.Dispose()
 
   def query_one(self, query) -> 'ManagementObject':
-    result = self.query(query)
+    result = self.query(query, limit=2)
     if len(result) > 1:
       raise Exception("Got too many results for query '%s'" % query)
     if result:
@@ -80,6 +262,89 @@ class ManagementScope(object):
     cls = ManagementClass(str(self.Path) + ":" + class_name)
     return cls.CreateInstance()
 
+  def reconnect(self):
+    """
+    Reconnects scope and invalidates all state bound to it.
+    """
+    self.Connect()
+    ScopeBound.invalidate_scope(self)
+
+
+def to_python_value(value):
+  """
+  Converts property value to plain python value that does not hold any reference to .Net object.
+
+  :param value: property value
+  :return: python value
+  """
+  if value is None or isinstance(value, (str, int, float, bool)):
+    return value
+  if isinstance(value, Array):
+    return tuple(to_python_value(item) for item in value)
+  return str(value)
+
+
+class ObjectRecord(object):
+  """
+  Immutable snapshot of some 'ManagementObject' properties. Does not hold any reference to .Net objects, so it is cheap
+  to keep. Use 'record_type' to get record class for particular set of properties.
+  """
+  __slots__ = ()
+  FIELDS = ()
+
+  def __init__(self, *values):
+    if len(values) != len(self.FIELDS):
+      raise ValueError("Expected %s values, got %s" % (len(self.FIELDS), len(values)))
+    for field, value in zip(self.FIELDS, values):
+      object.__setattr__(self, field, value)
+
+  @classmethod
+  def from_object(cls, management_object) -> 'ObjectRecord':
+    return cls(*[to_python_value(management_object.Properties[field].Value) for field in cls.FIELDS])
+
+  def __setattr__(self, key, value):
+    raise AttributeError("'%s' is immutable" % type(self).__name__)
+
+  def __delattr__(self, key):
+    raise AttributeError("'%s' is immutable" % type(self).__name__)
+
+  def __getitem__(self, item):
+    if item not in self.FIELDS:
+      raise KeyError(item)
+    return getattr(self, item)
+
+  def as_dict(self):
+    return {field: getattr(self, field) for field in self.FIELDS}
+
+  def __eq__(self, other):
+    return type(self) is type(other) and self.as_dict() == other.as_dict()
+
+  def __hash__(self):
+    return hash(tuple(getattr(self, field) for field in self.FIELDS))
+
+  def __repr__(self):
+    return "%s(%s)" % (type(self).__name__, ", ".join("%s=%r" % (f, getattr(self, f)) for f in self.FIELDS))
+
+
+_record_types = {}
+_record_types_lock = threading.Lock()
+
+
+def record_type(fields: Sequence[str]) -> type:
+  """
+  Returns 'ObjectRecord' subclass with slots for given properties. Classes are cached, so same fields give same class.
+
+  :param fields: properties names
+  :return: record class
+  """
+  fields = tuple(fields)
+  with _record_types_lock:
+    cls = _record_types.get(fields)
+    if cls is None:
+      cls = type("ObjectRecord_%s" % "_".join(fields), (ObjectRecord,), {'__slots__': fields, 'FIELDS': fields})
+      _record_types[fields] = cls
+    return cls
+
 
 class JobException(Exception):
   def __init__(self, job):
@@ -104,6 +369,7 @@ class PropertiesHolder(object):
     if key != 'management_object':
       try:
         self.management_object.Properties[key].Value = value
+        embedded_instances.mark_dirty(self.management_object, key)
       except ManagementException:
         pass
       except AttributeError:
@@ -115,6 +381,7 @@ class PropertiesHolder(object):
 
   def __setitem__(self, key, value):
     self.management_object.Properties[key].Value = value
+    embedded_instances.mark_dirty(self.management_object, key)
 
   def __repr__(self):
     result = {}
@@ -123,6 +390,95 @@ class PropertiesHolder(object):
     return repr(result)
 
 
+class PropertySnapshot(object):
+  """
+  Snapshot of all 'ManagementObject' properties, read in one pass. Values are read and changed via item or attribute
+  access without touching underlying object. Changed properties are tracked and written back to object only by
+  'flush', which must be called before object is passed to WMI method::
+
+    snapshot = settings.snapshot()
+    snapshot.VirtualQuantity = 2
+    snapshot.flush()
+    management_service.ModifyResourceSettings(settings)
+
+  Property names are case insensitive, just like in WMI.
+  """
+
+  def __init__(self, management_object):
+    values = {}
+    names = {}
+    for _property in management_object.Properties:
+      values[_property.Name] = _property.Value
+      names[_property.Name.lower()] = _property.Name
+    object.__setattr__(self, '_management_object', management_object)
+    object.__setattr__(self, '_values', values)
+    object.__setattr__(self, '_names', names)
+    object.__setattr__(self, '_dirty', set())
+
+  def _name(self, key) -> str:
+    try:
+      return self._names[key.lower()]
+    except KeyError:
+      raise KeyError("Object has no property '%s'" % key) from None
+
+  def __getitem__(self, key):
+    return self._values[self._name(key)]
+
+  def __setitem__(self, key, value):
+    name = self._name(key)
+    self._values[name] = value
+    self._dirty.add(name)
+
+  def __getattr__(self, key):
+    try:
+      return self[key]
+    except KeyError as e:
+      raise AttributeError(str(e)) from None
+
+  def __setattr__(self, key, value):
+    try:
+      self[key] = value
+    except KeyError as e:
+      raise AttributeError(str(e)) from None
+
+  def __contains__(self, key):
+    return key.lower() in self._names
+
+  def __iter__(self):
+    return iter(self._values)
+
+  def update(self, properties):
+    for key, value in properties.items():
+      self[key] = value
+
+  @property
+  def dirty(self) -> frozenset:
+    """
+    Names of properties that were changed since snapshot was taken or flushed.
+    """
+    return frozenset(self._dirty)
+
+  def flush(self) -> int:
+    """
+    Writes changed properties back to underlying object.
+
+    :return: number of written properties
+    """
+    properties = self._management_object.Properties
+    for name in self._dirty:
+      properties[name].Value = self._values[name]
+      embedded_instances.mark_dirty(self._management_object, name)
+    flushed = len(self._dirty)
+    self._dirty.clear()
+    return flushed
+
+  def as_dict(self):
+    return dict(self._values)
+
+  def __repr__(self):
+    return repr(self._values)
+
+
 @opencls(ManagementObject)
 class ManagementObject(object):
   def check_class(self, cls):
@@ -131,6 +487,7 @@ class ManagementObject(object):
 
   def reload(self):
     self.Get()
+    embedded_instances.discard(self)
 
   @property
   def properties(self):
@@ -138,10 +495,15 @@ class ManagementObject(object):
 
   @property
   def properties_dict(self):
-    result = {}
-    for _property in self.Properties:
-      result[_property.Name] |= _property.Value
-    return result
+    return self.snapshot().as_dict()
+
+  def snapshot(self) -> 'PropertySnapshot':
+    """
+    Reads all properties in one pass and returns their snapshot with dirty tracking.
+
+    :return: properties snapshot
+    """
+    return PropertySnapshot(self)
 
   def traverse(self, traverse_path: Sequence[Node]) -> List[List[ManagementObject]]:
     """
@@ -153,55 +515,73 @@ class ManagementObject(object):
     """
     return recursive_traverse(traverse_path, self)
 
+  def iter_traverse(self, traverse_path: Sequence[Node]) -> Iterator[Tuple[ManagementObject, ...]]:
+    """
+    Lazy version of 'traverse', yields found paths one by one.
+
+    :param traverse_path:
+    :return: iterator over found paths
+    """
+    return iter_traverse(traverse_path, self)
+
   def get_child(self, traverse_path: Sequence[Node]) -> ManagementObject:
     """
-    Get one child item from given path.
+    Get one child item from given path. Traversal stops as soon as second child is found.
 
     :param traverse_path:
     :return:
     """
-    traverse_result = self.traverse(traverse_path)
-    if len(traverse_result) > 1:
-      raise Exception("Found more that one child for given path")
-    return traverse_result[-1][-1]
+    return only(self.iter_traverse(traverse_path))[-1]
 
-  def invoke(self, method_name, **kwargs):
-    parameters = self.GetMethodParameters(method_name)
-    for parameter in parameters.Properties:
-      parameter_name = parameter.Name
-      parameter_type = CimTypeTransformer.target_class(parameter.Type)
+  def first_child(self, traverse_path: Sequence[Node]) -> ManagementObject:
+    """
+    Get first child item from given path. Traversal stops as soon as it is found.
 
-      if parameter_name not in kwargs:
-        raise ValueError("Parameter '%s' not provided" % parameter_name)
+    :param traverse_path:
+    :return: found child or ``None``
+    """
+    path = first(self.iter_traverse(traverse_path))
+    if path:
+      return path[-1]
 
-      if parameter.IsArray:
-        if not isinstance(kwargs[parameter_name], collections.Iterable):
-          raise ValueError("Parameter '%s' must be iterable" % parameter_name)
-        array_items = [transform_argument(item, parameter_type) for item in kwargs[parameter_name]]
-        if array_items:
-          parameter_value = Array[parameter_type](array_items)
-        else:
-          parameter_value = None
-      else:
-        parameter_value = transform_argument(kwargs[parameter_name], parameter_type)
+  def invoke(self, method_name, **kwargs):
+    signature = MethodSignatures.for_scope(self.Scope).get(self, method_name)
+    invocation_result = self.InvokeMethod(method_name, signature.prepare(kwargs), None)
+    return signature.transform(invocation_result)
 
-      parameters.Properties[parameter_name].Value = parameter_value
+  async def invoke_async(self, method_name, **kwargs):
+    """
+    Invokes method asynchronously, see 'invoke'. No thread is held until method returns.
+    """
+    signature = MethodSignatures.for_scope(self.Scope).get(self, method_name)
+    parameters = signature.prepare(kwargs)
+    results = await observe(lambda observer: self.InvokeMethod(observer, method_name, parameters, None),
+                            signature.transform)
+    # method without output parameters delivers nothing, same as 'transform' of missing result
+    return results[-1] if results else {}
+
+  async def get_async(self) -> 'ManagementObject':
+    """
+    Loads object asynchronously.
+    """
+    await observe(lambda observer: self.Get(observer))
+    return self
 
-    invocation_result = self.InvokeMethod(method_name, parameters, None)
-    transformed_result = {}
-    for _property in invocation_result.Properties:
-      _property_type = CimTypeTransformer.target_class(_property.Type)
-      _property_value = None
-      if _property.Value is not None:
-        if _property.IsArray:
-          _property_value = [transform_argument(item, _property_type) for item in _property.Value]
-        else:
-          _property_value = transform_argument(_property.Value, _property_type)
-      transformed_result[_property.Name] = _property_value
-    return transformed_result
+  async def related_async(self, related_class=None) -> List['ManagementObject']:
+    """
+    Gets related objects asynchronously.
+
+    :param related_class: class of related objects, all related objects are returned if not given
+    :return: list of related objects
+    """
+    if related_class is None:
+      return await observe(lambda observer: self.GetRelated(observer))
+    return await observe(lambda observer: self.GetRelated(observer, related_class))
 
   def clone(self):
-    return self.Clone()
+    clone = self.Clone()
+    embedded_instances.register_clone(self, clone)
+    return clone
 
   def __str__(self):
     return str(self)
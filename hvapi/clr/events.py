@@ -0,0 +1,183 @@
+# The MIT License
+#
+# Copyright (c) 2017 Eugene Chekanskiy, echekanskiy@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import logging
+import threading
+from abc import ABCMeta, abstractmethod
+from typing import Callable, Dict, Any, Sequence
+
+from hvapi.clr.imports import ManagementEventWatcher, WqlEventQuery, EventArrivedEventHandler
+
+# handler receives event class name, e.g. '__InstanceModificationEvent', and properties of target instance
+EventHandler = Callable[[str, Dict[str, Any]], None]
+
+
+class EventSource(metaclass=ABCMeta):
+  """
+  Source of instance events. Delivers event class name and selected properties of target instance to handler.
+  """
+
+  @abstractmethod
+  def start(self, handler: EventHandler):
+    raise NotImplementedError
+
+  @abstractmethod
+  def stop(self):
+    raise NotImplementedError
+
+
+class WqlEventSource(EventSource):
+  """
+  Event source based on 'ManagementEventWatcher' with WQL event query. Properties of target instance are copied to
+  dict, so handlers do not hold any references to .Net objects.
+  """
+
+  def __init__(self, scope, query, properties: Sequence[str]):
+    """
+    :param scope: scope to watch events in
+    :param query: WQL event query, e.g. "SELECT * FROM __InstanceModificationEvent WITHIN 1 WHERE ..."
+    :param properties: properties of target instance to pass to handler
+    """
+    self.scope = scope
+    self.query = query
+    self.properties = properties
+    self._watcher = None
+    self._event_handler = None
+
+  def start(self, handler: EventHandler):
+    def on_event_arrived(sender, args):
+      event = args.NewEvent
+      target_instance = event.Properties['TargetInstance'].Value
+      handler(event.ClassPath.ClassName,
+              {name: target_instance.Properties[name].Value for name in self.properties})
+
+    self._watcher = ManagementEventWatcher(self.scope, WqlEventQuery(self.query))
+    self._event_handler = EventArrivedEventHandler(on_event_arrived)
+    self._watcher.EventArrived += self._event_handler
+    self._watcher.Start()
+
+  def stop(self):
+    if self._watcher is not None:
+      self._watcher.Stop()
+      self._watcher.EventArrived -= self._event_handler
+      self._watcher.Dispose()
+      self._watcher = None
+      self._event_handler = None
+
+
+class ManualEventSource(EventSource):
+  """
+  Event source that delivers events passed to 'emit'. Useful for testing and for feeding events from other sources.
+  """
+
+  def __init__(self):
+    self._handler = None
+
+  def start(self, handler: EventHandler):
+    self._handler = handler
+
+  def stop(self):
+    self._handler = None
+
+  def emit(self, event_class, properties: Dict[str, Any]):
+    if self._handler is not None:
+      self._handler(event_class, properties)
+
+
+class EventDispatcher(object):
+  """
+  Dispatches events of one source to subscribers by value of key property of target instance. Source is started on
+  first subscription, is shared by all subscribers and is stopped when last subscriber leaves.
+  """
+  LOG = logging.getLogger('%s.%s' % (__module__, __qualname__))
+
+  def __init__(self, source: EventSource, key_property):
+    self.source = source
+    self.key_property = key_property
+    self._subscribers = {}
+    self._running = False
+    self._lock = threading.RLock()
+
+  @property
+  def running(self) -> bool:
+    return self._running
+
+  def subscribe(self, key, callback: EventHandler):
+    """
+    Subscribes callback for events of instance with given key, or for all events if key is ``None``.
+
+    :return: subscription token for 'unsubscribe'
+    """
+    with self._lock:
+      if not self._running:
+        self.source.start(self._dispatch)
+        self._running = True
+      token = (key, callback)
+      self._subscribers.setdefault(key, []).append(callback)
+      return token
+
+  def unsubscribe(self, token):
+    key, callback = token
+    with self._lock:
+      callbacks = self._subscribers.get(key, [])
+      if callback in callbacks:
+        callbacks.remove(callback)
+      if not callbacks:
+        self._subscribers.pop(key, None)
+      if not self._subscribers:
+        self.stop()
+
+  def ensure_running(self):
+    """
+    Restarts stopped source if there are subscribers, e.g. after scope reconnection.
+    """
+    with self._lock:
+      if not self._running and self._subscribers:
+        self.source.start(self._dispatch)
+        self._running = True
+
+  def replace_source(self, source: EventSource):
+    """
+    Replaces source of events, subscribers are kept.
+    """
+    with self._lock:
+      self.stop()
+      self.source = source
+      self.ensure_running()
+
+  def stop(self):
+    """
+    Stops source, subscribers are kept and source is started again by next 'subscribe' or 'ensure_running'.
+    """
+    with self._lock:
+      if self._running:
+        self._running = False
+        self.source.stop()
+
+  def _dispatch(self, event_class, properties: Dict[str, Any]):
+    key = properties.get(self.key_property)
+    with self._lock:
+      callbacks = list(self._subscribers.get(key, ())) + list(self._subscribers.get(None, ()))
+    for callback in callbacks:
+      try:
+        callback(event_class, properties)
+      except Exception:
+        self.LOG.exception("Event callback failed")
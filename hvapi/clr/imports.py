@@ -26,8 +26,12 @@ Assembly.LoadWithPartialName("Microsoft.HyperV.PowerShell.Objects")
 Assembly.LoadWithPartialName("Microsoft.HyperV.PowerShell.Cmdlets")
 clr.AddReference("System.Management")
 
-from System.Management import ManagementScope, ObjectQuery, ManagementObjectSearcher, ManagementObject, CimType, ManagementException, ManagementClass
+from System.Management import ManagementScope, ObjectQuery, ManagementObjectSearcher, ManagementObject, CimType, ManagementException, ManagementClass, ManagementStatus, EnumerationOptions, ConnectionOptions, \
+  ManagementPath, ObjectGetOptions, ManagementEventWatcher, WqlEventQuery, EventArrivedEventHandler, \
+  ManagementOperationObserver, ObjectReadyEventHandler, CompletedEventHandler
+from System import TimeSpan
 from System import Array, String, Guid
+from System.Runtime.InteropServices import COMException
 from System.Management.Automation import PowerShell, PSObject
 # WARNING, clr_Array accepts iterable, e.g. if you will pass string - it will be array of its chars, not array of one
 # string. clr_Array[clr_String](["hello"]) equals to array with one "hello" string in it
@@ -41,6 +45,19 @@ ManagementObject = ManagementObject
 CimType = CimType
 ManagementException = ManagementException
 ManagementClass = ManagementClass
+ManagementStatus = ManagementStatus
+EnumerationOptions = EnumerationOptions
+ConnectionOptions = ConnectionOptions
+ManagementPath = ManagementPath
+ObjectGetOptions = ObjectGetOptions
+ManagementEventWatcher = ManagementEventWatcher
+WqlEventQuery = WqlEventQuery
+EventArrivedEventHandler = EventArrivedEventHandler
+ManagementOperationObserver = ManagementOperationObserver
+ObjectReadyEventHandler = ObjectReadyEventHandler
+CompletedEventHandler = CompletedEventHandler
+TimeSpan = TimeSpan
+COMException = COMException
 Array = Array
 String = String
 Guid = Guid
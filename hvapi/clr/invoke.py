@@ -19,18 +19,26 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
+from concurrent.futures import Future
+
 from hvapi.clr.base import ManagementObject
 from hvapi.clr.types import InvocationException
 from hvapi.clr.imports import String
+from hvapi.clr.scope import ObjectFactory
+from hvapi.clr.serialization import embedded_instances
 from hvapi.common import RangedCodeEnum
 
+# jobs like disk merge or conversion may take hours, so they are waited without limit unless timeout is given
+DEFAULT_JOB_TIMEOUT = None
+
 
-def transform_argument(obj, expected_type=None):
+def transform_argument(obj, expected_type=None, scope=None):
   """
   Transforms input object to expected type.
 
   :param obj:
   :param expected_type:
+  :param scope: scope that objects created from references are bound to
   :return:
   """
   if obj is None:
@@ -39,13 +47,15 @@ def transform_argument(obj, expected_type=None):
   # management object to something that can be passed to function call
   if isinstance(obj, ManagementObject):
     if expected_type == String:
-      return String(obj.GetText(2))
+      return String(embedded_instances.serialize(obj))
     if expected_type == ManagementObject:
       return obj
     raise ValueError("Object '%s' can not be transformed to '%s'" % (obj, expected_type))
 
   if isinstance(obj, (String, str)):
     if expected_type == ManagementObject:
+      if scope is not None:
+        return ObjectFactory.for_scope(scope).get(obj)
       return ManagementObject(obj)
 
   if isinstance(obj, int):
@@ -63,7 +73,75 @@ def transform_argument(obj, expected_type=None):
   raise Exception("Unknown object to transform: '%s'" % obj)
 
 
-def evaluate_invocation_result(result, codes_enum: RangedCodeEnum, ok_value, job_value):
+def argument_converter(expected_type, scope=None):
+  """
+  Returns function that transforms objects to expected type like 'transform_argument' does, but branches that depend
+  only on expected type are resolved once. Used by compiled method signatures.
+
+  :param expected_type: type to transform objects to
+  :param scope: scope that objects created from references are bound to
+  :return: converter function
+  """
+  if expected_type == String:
+    def convert(obj):
+      if obj is None:
+        return None
+      if isinstance(obj, ManagementObject):
+        return String(embedded_instances.serialize(obj))
+      if isinstance(obj, (str, String)):
+        return String(obj)
+      raise Exception("Unknown object to transform: '%s'" % obj)
+  elif expected_type == ManagementObject:
+    factory = ObjectFactory.for_scope(scope) if scope is not None else None
+
+    def convert(obj):
+      if obj is None:
+        return None
+      if isinstance(obj, ManagementObject):
+        return obj
+      if isinstance(obj, (String, str)):
+        return factory.get(obj) if factory is not None else ManagementObject(obj)
+      raise Exception("Unknown object to transform: '%s'" % obj)
+  elif expected_type in (int, bool):
+    def convert(obj):
+      if obj is None or isinstance(obj, expected_type):
+        return obj
+      if isinstance(obj, ManagementObject):
+        raise ValueError("Object '%s' can not be transformed to '%s'" % (obj, expected_type))
+      raise Exception("Unknown object to transform: '%s'" % obj)
+  else:
+    def convert(obj):
+      return transform_argument(obj, expected_type, scope)
+  return convert
+
+
+class InvocationFuture(Future):
+  """
+  Future of method invocation result. It is resolved with invocation output parameters as soon as job started by
+  invocation finishes, ``job`` is 'JobFuture' of that job or ``None`` if method completed synchronously.
+  """
+
+  def __init__(self, result, job=None):
+    super().__init__()
+    self.job = job
+    if job is None:
+      self.set_result(result)
+    else:
+      job.add_done_callback(lambda _job: self._job_done(_job, result))
+
+  def _job_done(self, job, result):
+    if job.cancelled():
+      self.cancel()
+      return
+    exception = job.exception()
+    if exception is not None:
+      self.set_exception(exception)
+    else:
+      self.set_result(result)
+
+
+def evaluate_invocation_result(result, codes_enum: RangedCodeEnum, ok_value, job_value, wait=True,
+                               timeout=DEFAULT_JOB_TIMEOUT):
   """
   Evaluates invocation results from 'ManagementObject'. All method invocations returns object that contains return code
   ('ReturnValue' field), invocation result or reference for Job that need to be waited for to have some result.
@@ -72,13 +150,20 @@ def evaluate_invocation_result(result, codes_enum: RangedCodeEnum, ok_value, job
   :param codes_enum:
   :param ok_value:
   :param job_value:
+  :param wait: if ``False``, job is not waited for and 'InvocationFuture' is returned instead of result
+  :param timeout: seconds to wait for job, ``None`` to wait without limit
   :return:
   """
   return_value = codes_enum.from_code(result['ReturnValue'])
   if return_value == job_value:
     from hvapi._private import JobWrapper
-    JobWrapper(result['Job']).wait()
+    job = JobWrapper(result['Job']).submit()
+    if not wait:
+      return InvocationFuture(result, job)
+    job.wait(timeout)
     return result
   if return_value != ok_value:
     raise InvocationException("Failed execute method with return value '%s'" % return_value.name)
+  if not wait:
+    return InvocationFuture(result)
   return result
@@ -0,0 +1,143 @@
+# The MIT License
+#
+# Copyright (c) 2017 Eugene Chekanskiy, echekanskiy@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import threading
+
+from hvapi.clr.imports import ConnectionOptions, ManagementObject, ManagementPath, ObjectGetOptions
+
+CONNECTION_TAG = 'hvapi_connection'
+
+
+def scope_key(scope) -> str:
+  """
+  Returns key that identifies given 'ManagementScope' regardless of particular .Net instance. Objects copy scope of
+  their source, so key is built from values that are copied with it: path and connection tag, see 'tag_connection'.
+
+  :param scope: management scope
+  :return: normalized scope path with connection tag
+  """
+  key = str(scope.Path).lower()
+  tag = scope.Options.Context[CONNECTION_TAG]
+  if tag is not None:
+    key = '%s#%s' % (key, tag)
+  return key
+
+
+def tag_connection(options: ConnectionOptions, tag) -> ConnectionOptions:
+  """
+  Returns copy of connection options with given tag. Scopes with same path and different tags get different keys, so
+  each of them has its own services, templates and other 'ScopeBound' state bound to its own connection.
+
+  :param options: connection options to copy, default options if ``None``
+  :param tag: tag unique for scope path
+  :return: tagged connection options
+  """
+  options = options.Clone() if options is not None else ConnectionOptions()
+  options.Context.Add(CONNECTION_TAG, str(tag))
+  return options
+
+
+class ScopeBound(object):
+  """
+  Base class for objects that keep some state for particular 'ManagementScope', e.g. resolved services or caches.
+  There is only one instance of each subclass per scope, use 'for_scope' to get it. All instances bound to scope are
+  invalidated when scope is reconnected.
+  """
+  _instances = {}
+  _instances_lock = threading.RLock()
+
+  def __init__(self, scope):
+    self.scope = scope
+
+  @classmethod
+  def for_scope(cls, scope):
+    key = (cls, scope_key(scope))
+    with ScopeBound._instances_lock:
+      instance = ScopeBound._instances.get(key)
+      if instance is None:
+        instance = cls(scope)
+        ScopeBound._instances[key] = instance
+      return instance
+
+  @staticmethod
+  def invalidate_scope(scope):
+    key = scope_key(scope)
+    with ScopeBound._instances_lock:
+      instances = [instance for (_, _key), instance in ScopeBound._instances.items() if _key == key]
+    for instance in instances:
+      instance.invalidate()
+
+  @staticmethod
+  def discard_scope(scope):
+    """
+    Invalidates and forgets all instances bound to scope that will not be used anymore.
+    """
+    key = scope_key(scope)
+    with ScopeBound._instances_lock:
+      instances = [ScopeBound._instances.pop(_key) for _key in list(ScopeBound._instances) if _key[1] == key]
+    for instance in instances:
+      instance.invalidate()
+
+  def invalidate(self):
+    """
+    Drops all state that depends on scope connection.
+    """
+    pass
+
+
+class ObjectFactory(ScopeBound):
+  """
+  Creates 'ManagementObject' instances from paths bound to shared connection of scope. Objects created directly from
+  path are bound to default scope and open their own connection on first access, so all objects created during
+  traversal and method invocation must be created by factory of originating scope.
+  """
+
+  def __init__(self, scope):
+    super().__init__(scope)
+    self.objects_created = 0
+    self.connections_opened = 0
+    self._lock = threading.Lock()
+
+  def connect(self):
+    """
+    Connects scope if it is not connected yet. Connection is shared by all objects created by factory.
+    """
+    if not self.scope.IsConnected:
+      with self._lock:
+        if not self.scope.IsConnected:
+          self.scope.Connect()
+          self.connections_opened += 1
+
+  def get(self, path) -> ManagementObject:
+    """
+    Creates object for given path bound to scope. Object is not loaded until its properties are accessed.
+
+    :param path: object path
+    :return: bound object
+    """
+    self.connect()
+    with self._lock:
+      self.objects_created += 1
+    return ManagementObject(self.scope, ManagementPath(str(path)), ObjectGetOptions())
+
+  def invalidate(self):
+    with self._lock:
+      self.connections_opened = 0
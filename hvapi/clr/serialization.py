@@ -0,0 +1,200 @@
+# The MIT License
+#
+# Copyright (c) 2017 Eugene Chekanskiy, echekanskiy@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import re
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional
+from xml.sax.saxutils import escape
+
+# 'TextFormat.WmiDtd20'
+WMI_DTD_20 = 2
+
+
+class _Entry(object):
+  __slots__ = ('obj', 'text', 'generation', 'serialized_generation', 'dirty')
+
+  def __init__(self, obj, text):
+    self.obj = obj
+    self.text = text
+    self.generation = 0
+    self.serialized_generation = 0
+    self.dirty = set()
+
+
+class EmbeddedInstanceCache(object):
+  """
+  Caches CIM-XML text of objects passed as embedded instances to methods. Entries are keyed by object identity and
+  have dirty generation counter, that is increased by 'mark_dirty' on every property change made through
+  ``properties``, 'PropertySnapshot' or 'PropertiesHolder'. Text of changed object is patched for changed properties
+  only, full serialization is done only if some changed property can not be patched. Clones inherit text of their
+  source, so cloned templates are serialized once. Changes made directly through .Net 'Properties' collection are not
+  tracked, such objects must be passed to 'discard'.
+
+  Entries hold their objects, so object identity can not be reused while it is cached. Cache keeps at most
+  ``max_size`` recently used entries.
+  """
+  DEFAULT_MAX_SIZE = 256
+
+  def __init__(self, max_size=DEFAULT_MAX_SIZE):
+    self.max_size = max_size
+    self.hits = 0
+    self.patches = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def serialize(self, obj) -> str:
+    """
+    Returns CIM-XML text of object.
+    """
+    with self._lock:
+      entry = self._entry(obj)
+      if entry is not None and entry.serialized_generation == entry.generation:
+        self.hits += 1
+        return entry.text
+      dirty = set(entry.dirty) if entry is not None else None
+      generation = entry.generation if entry is not None else 0
+      text = entry.text if entry is not None else None
+    patched = False
+    if text is not None:
+      text = _patch(text, obj, dirty)
+      patched = text is not None
+    if text is None:
+      text = obj.GetText(WMI_DTD_20)
+    with self._lock:
+      if patched:
+        self.patches += 1
+      else:
+        self.misses += 1
+      entry = self._entry(obj)
+      if entry is None:
+        entry = self._put(obj, text)
+        entry.generation = generation
+      elif entry.generation != generation:
+        # changed while being serialized, keep text for next patch, but do not claim it is actual
+        return text
+      entry.text = text
+      entry.serialized_generation = generation
+      entry.dirty.clear()
+      return text
+
+  def mark_dirty(self, obj, name):
+    """
+    Records that property ``name`` of ``obj`` was changed.
+    """
+    with self._lock:
+      entry = self._entry(obj)
+      if entry is not None:
+        entry.generation += 1
+        entry.dirty.add(name)
+
+  def register_clone(self, source, clone):
+    """
+    Lets ``clone`` inherit serialized text of ``source``.
+    """
+    with self._lock:
+      entry = self._entry(source)
+      if entry is None:
+        return
+      clone_entry = self._put(clone, entry.text)
+      if entry.serialized_generation != entry.generation:
+        clone_entry.generation = 1
+        clone_entry.dirty.update(entry.dirty)
+
+  def discard(self, obj):
+    """
+    Drops cached text of object, e.g. when it was reloaded or changed directly.
+    """
+    with self._lock:
+      entry = self._entry(obj)
+      if entry is not None:
+        del self._entries[id(obj)]
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def _entry(self, obj) -> Optional[_Entry]:
+    entry = self._entries.get(id(obj))
+    if entry is None or entry.obj is not obj:
+      return None
+    self._entries.move_to_end(id(obj))
+    return entry
+
+  def _put(self, obj, text) -> _Entry:
+    entry = _Entry(obj, text)
+    self._entries[id(obj)] = entry
+    self._entries.move_to_end(id(obj))
+    while len(self._entries) > self.max_size:
+      self._entries.popitem(last=False)
+    return entry
+
+
+def _format_value(value) -> Optional[str]:
+  if isinstance(value, bool):
+    return None
+  if isinstance(value, int):
+    return str(value)
+  if isinstance(value, str):
+    return escape(value, {'"': '&quot;'})
+  return None
+
+
+def _value_markup(value) -> Optional[str]:
+  """
+  Returns markup of property value or ``None`` if value type can not be patched.
+  """
+  if value is None:
+    return ""
+  formatted = _format_value(value)
+  if formatted is not None:
+    return "<VALUE>%s</VALUE>" % formatted
+  if isinstance(value, Iterable):
+    items = [_format_value(item) for item in value]
+    if any(item is None for item in items):
+      return None
+    return "<VALUE.ARRAY>%s</VALUE.ARRAY>" % "".join("<VALUE>%s</VALUE>" % item for item in items)
+  return None
+
+
+def _patch(text, obj, names) -> Optional[str]:
+  """
+  Replaces values of given properties in CIM-XML text. Returns ``None`` if any property can not be patched.
+  """
+  for name in names:
+    markup = _value_markup(obj.Properties[name].Value)
+    if markup is None:
+      return None
+    match = re.search(r'<(PROPERTY(?:\.ARRAY)?) NAME="%s"[^>]*>' % re.escape(name), text)
+    if match is None:
+      return None
+    end = text.find('</%s>' % match.group(1), match.end())
+    if end < 0:
+      return None
+    body = text[match.end():end]
+    # qualifiers have values too, property value is everything after last qualifier
+    value_start = match.end() + (body.rfind('</QUALIFIER>') + len('</QUALIFIER>') if '</QUALIFIER>' in body else 0)
+    text = text[:value_start] + markup + text[end:]
+  return text
+
+
+embedded_instances = EmbeddedInstanceCache()
@@ -19,9 +19,38 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
-from typing import Sequence
+import threading
+import time
+from typing import Sequence, Iterator, Tuple
 from abc import ABCMeta, abstractmethod
 from hvapi.clr.imports import ManagementObject
+from hvapi.clr.scope import ObjectFactory
+
+
+def wql_literal(value) -> str:
+  """
+  Formats python value as WQL literal.
+
+  :param value: string, number or boolean
+  :return: WQL literal
+  """
+  if isinstance(value, bool):
+    return 'TRUE' if value else 'FALSE'
+  if isinstance(value, int):
+    return str(value)
+  return "'%s'" % str(value).replace('\\', '\\\\').replace("'", "\\'")
+
+
+def wql_like_prefix(value: str) -> str:
+  """
+  Formats WQL 'LIKE' pattern that matches all strings that start with given value.
+
+  :param value: prefix
+  :return: WQL literal with pattern
+  """
+  # ']' and '^' are special only inside of '[]' set, so they are matched literally as is
+  escaped = ''.join('[%s]' % char if char in '[%_' else char for char in value)
+  return wql_literal(escaped + '%')
 
 
 class PropertyTransformer(metaclass=ABCMeta):
@@ -47,11 +76,11 @@ class NullTransformer(PropertyTransformer):
 
 class ReferenceTransformer(PropertyTransformer):
   """
-  Transforms WMI reference value to 'ManagementObject' instance.
+  Transforms WMI reference value to 'ManagementObject' instance bound to scope of parent object.
   """
 
   def transform(self, property_value, parent: ManagementObject) -> ManagementObject:
-    return ManagementObject(property_value)
+    return ObjectFactory.for_scope(parent.Scope).get(property_value)
 
 
 class Selector(metaclass=ABCMeta):
@@ -63,6 +92,20 @@ class Selector(metaclass=ABCMeta):
   def is_acceptable(self, management_object: ManagementObject) -> bool:
     return False
 
+  def to_wql(self):
+    """
+    Returns WQL condition equal to this selector, or ``None`` if selector can not be expressed in WQL and objects must
+    be checked on client side.
+    """
+    return None
+
+  @property
+  def key(self):
+    """
+    Hashable value, selectors with equal keys select same objects.
+    """
+    return type(self).__name__, id(self)
+
 
 class NullSelector(Selector):
   """
@@ -72,6 +115,13 @@ class NullSelector(Selector):
   def is_acceptable(self, management_object: ManagementObject) -> bool:
     return True
 
+  def to_wql(self) -> str:
+    return ""
+
+  @property
+  def key(self):
+    return type(self).__name__,
+
 
 class PropertiesSelector(Selector):
   """
@@ -80,21 +130,47 @@ class PropertiesSelector(Selector):
 
   def __init__(self, **kwargs):
     self.properties = kwargs
+    self._expected = [(name, value, str(value)) for name, value in kwargs.items()]
 
   def is_acceptable(self, management_object: ManagementObject) -> bool:
-    for property_name, expected_value in self.properties.items():
-      if str(management_object.properties[property_name]) != str(expected_value):
+    for property_name, expected_value, expected_str in self._expected:
+      value = management_object.Properties[property_name].Value
+      if value != expected_value and str(value) != expected_str:
         return False
     return True
 
+  def to_wql(self) -> str:
+    return " AND ".join("%s = %s" % (name, wql_literal(value)) for name, value in self.properties.items())
+
+  @property
+  def key(self):
+    return type(self).__name__, tuple(sorted((name, expected_str) for name, _, expected_str in self._expected))
+
 
 class Node(object):
   """
-  Object that used to get child items from given 'ManagementObject' during traversal.
+  Object that used to get child items from given 'ManagementObject' during traversal. Subclasses must implement
+  either 'get_node_objects' or lazy 'iter_node_objects'.
   """
 
   def get_node_objects(self, management_object: ManagementObject):
-    raise NotImplementedError
+    return list(self.iter_node_objects(management_object))
+
+  def iter_node_objects(self, management_object: ManagementObject) -> Iterator[ManagementObject]:
+    return iter(self.get_node_objects(management_object))
+
+  def compile(self, management_object: ManagementObject):
+    """
+    Returns WQL query that selects child items of given object, or ``None`` if node is resolved without query.
+    """
+    return None
+
+  @property
+  def key(self):
+    """
+    Hashable value, nodes with equal keys give same child items for same object. Used by 'TraversalSession'.
+    """
+    return type(self).__name__, id(self)
 
 
 class PropertyNode(Node):
@@ -107,6 +183,10 @@ class PropertyNode(Node):
     self.transformer = transformer
     self.selector = selector
 
+  @property
+  def key(self):
+    return type(self).__name__, self.property_name, type(self.transformer).__name__, self.selector.key
+
   def get_node_objects(self, management_object: ManagementObject):
     results = []
     val = management_object.Properties[self.property_name].Value
@@ -122,68 +202,318 @@ class PropertyNode(Node):
     return results
 
 
+def _query_keywords(names, values) -> str:
+  keywords = []
+  for name, value in zip(names, values):
+    if name == 'ClassDefsOnly':
+      if value:
+        keywords.append(name)
+    elif value:
+      keywords.append("%s = %s" % (name, value))
+  return " WHERE " + " ".join(keywords) if keywords else ""
+
+
 class RelatedNode(Node):
   """
-  Gets 'ManagementObject' instances from property `GetRelated` method call.
+  Gets 'ManagementObject' instances related to given object. Compiled to 'ASSOCIATORS OF' query, arguments have
+  same meaning as for `GetRelated` method call.
   """
+  KEYWORDS = ('ResultClass', 'AssocClass', 'RequiredAssocQualifier', 'RequiredQualifier', 'ResultRole', 'Role',
+              'ClassDefsOnly')
 
   def __init__(self, related_arguments, selector: Selector = NullSelector()):
     """
 
     :param related_arguments: arguments to be passed to `GetRelated` method call
-    :param selector:
+    :param selector: selector that is applied on client side, 'ASSOCIATORS OF' does not support property conditions
     """
     self.related_arguments = related_arguments
     self.selector = selector
+    self.query_template = "ASSOCIATORS OF {%s}" + _query_keywords(self.KEYWORDS, related_arguments)
 
-  def get_node_objects(self, management_object: ManagementObject):
-    results = []
-    for rel_object in management_object.GetRelated(*self.related_arguments):
+  def compile(self, management_object: ManagementObject) -> str:
+    return self.query_template % management_object.Path.RelativePath
+
+  @property
+  def key(self):
+    return type(self).__name__, self.query_template, self.selector.key
+
+  def iter_node_objects(self, management_object: ManagementObject) -> Iterator[ManagementObject]:
+    for rel_object in management_object.Scope.iter_query(self.compile(management_object)):
       if not management_object == rel_object:
-        _result = rel_object
-        if self.selector.is_acceptable(_result):
-          results.append(_result)
-    return results
+        if self.selector.is_acceptable(rel_object):
+          yield rel_object
 
 
 class RelationshipNode(Node):
   """
-  Gets 'ManagementObject' instances from property `GetRelationships` method call.
+  Gets association objects that refer to given object. Compiled to 'REFERENCES OF' query, arguments have same meaning
+  as for `GetRelationships` method call.
   """
+  KEYWORDS = ('ResultClass', 'RequiredQualifier', 'Role', 'ClassDefsOnly')
 
   def __init__(self, relationship_arguments, selector: Selector = NullSelector()):
     """
 
     :param relationship_arguments: arguments to be passed to `GetRelationships` method call
-    :param selector:
+    :param selector: selector that is applied on client side, 'REFERENCES OF' does not support property conditions
     """
 
     self.relationship_arguments = relationship_arguments
     self.selector = selector
+    self.query_template = "REFERENCES OF {%s}" + _query_keywords(self.KEYWORDS, relationship_arguments)
 
-  def get_node_objects(self, management_object: ManagementObject):
-    results = []
-    for rel_object in management_object.GetRelationships(*self.relationship_arguments):
+  def compile(self, management_object: ManagementObject) -> str:
+    return self.query_template % management_object.Path.RelativePath
+
+  @property
+  def key(self):
+    return type(self).__name__, self.query_template, self.selector.key
+
+  def iter_node_objects(self, management_object: ManagementObject) -> Iterator[ManagementObject]:
+    for rel_object in management_object.Scope.iter_query(self.compile(management_object)):
       if not management_object == rel_object:
-        _result = rel_object
-        if self.selector.is_acceptable(_result):
-          results.append(_result)
-    return results
+        if self.selector.is_acceptable(rel_object):
+          yield rel_object
+
+
+class ComponentSettingsNode(Node):
+  """
+  Gets settings objects of class `class_name` that are components of given settings object, e.g. resource allocation
+  settings of 'Msvm_VirtualSystemSettingData'. Hyper-V builds 'InstanceID' of component settings from 'InstanceID' of
+  owner, so node is compiled to plain 'SELECT' query and selector is pushed into its 'WHERE' clause when possible.
+  """
+
+  def __init__(self, class_name, selector: Selector = NullSelector()):
+    self.class_name = class_name
+    self.selector = selector
+    self.condition = selector.to_wql()
+
+  @property
+  def key(self):
+    return type(self).__name__, self.class_name, self.selector.key
+
+  def compile(self, management_object: ManagementObject) -> str:
+    query = "SELECT * FROM %s WHERE InstanceID LIKE %s" % (
+      self.class_name, wql_like_prefix(management_object.Properties['InstanceID'].Value + '\\'))
+    if self.condition:
+      query += " AND %s" % self.condition
+    return query
+
+  def iter_node_objects(self, management_object: ManagementObject) -> Iterator[ManagementObject]:
+    for _result in management_object.Scope.iter_query(self.compile(management_object)):
+      # selector is already applied by query if it was compiled to WQL
+      if self.condition is not None or self.selector.is_acceptable(_result):
+        yield _result
 
 
 VirtualSystemSettingDataNode = RelatedNode(("Msvm_VirtualSystemSettingData", "Msvm_SettingsDefineState", None, None, "SettingData", "ManagedElement", False, None))
+# path from primordial 'Msvm_ResourcePool' to its default allocation settings
+DefaultSettingsPath = (
+  RelatedNode(("Msvm_AllocationCapabilities", "Msvm_ElementCapabilities", None, None, None, None, False, None)),
+  RelationshipNode(("Msvm_SettingsDefineCapabilities",), selector=PropertiesSelector(ValueRole=0)),
+  PropertyNode("PartComponent", transformer=ReferenceTransformer())
+)
+
+
+class _NodeResults(object):
+  """
+  Objects found by node for one object. Objects are taken from ``source`` only when some consumer asks for them, so
+  consumers that stop early, like 'first', leave source open and next consumer continues from where they stopped.
+  """
+  __slots__ = ('created', 'objects', 'source', 'lock')
+
+  def __init__(self, source: Iterator[ManagementObject]):
+    self.created = time.monotonic()
+    self.objects = []
+    self.source = source
+    self.lock = threading.Lock()
+
+  def close(self):
+    with self.lock:
+      source, self.source = self.source, None
+    close = getattr(source, 'close', None)
+    if close is not None:
+      close()
+
+
+class TraversalSession(object):
+  """
+  Memoizes child items found by nodes during traversal, so composite operations never resolve same node for same
+  object twice. Session is active for current thread inside ``with`` block::
+
+    with TraversalSession():
+      vm.apply_properties_group(properties_group)
+
+  Results are kept for session lifetime or for ``ttl`` seconds. Session is invalidated after service method calls that
+  may change objects hierarchy, like adding or removing resources. Calls that only modify existing objects keep it.
+  """
+  _local = threading.local()
+
+  def __init__(self, ttl=None):
+    self.ttl = ttl
+    self._cache = {}
+    self._lock = threading.Lock()
+
+  def __enter__(self) -> 'TraversalSession':
+    self._stack().append(self)
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self._stack().remove(self)
+    self.invalidate()
+
+  @classmethod
+  def _stack(cls) -> list:
+    stack = getattr(cls._local, 'stack', None)
+    if stack is None:
+      stack = cls._local.stack = []
+    return stack
+
+  @classmethod
+  def current(cls):
+    """
+    Returns innermost active session of current thread or ``None``.
+    """
+    stack = cls._stack()
+    return stack[-1] if stack else None
+
+  @classmethod
+  def invalidate_current(cls):
+    for session in cls._stack():
+      session.invalidate()
+
+  def invalidate(self):
+    with self._lock:
+      results = list(self._cache.values())
+      self._cache.clear()
+    for node_results in results:
+      node_results.close()
+
+  def iter_node_objects(self, node: Node, management_object: ManagementObject) -> Iterator[ManagementObject]:
+    """
+    Yields cached child items and resolves node lazily for the rest. Consumed prefix of results is cached, so
+    'first_child' lookups are memoized too and later consumers resume resolution from where previous ones stopped.
+    """
+    key = (str(management_object.Path.Path).lower(), node.key)
+    expired = None
+    with self._lock:
+      node_results = self._cache.get(key)
+      if node_results is not None and self.ttl is not None and time.monotonic() - node_results.created >= self.ttl:
+        expired, node_results = node_results, None
+      if node_results is None:
+        node_results = self._cache[key] = _NodeResults(node.iter_node_objects(management_object))
+    if expired is not None:
+      expired.close()
+    index = 0
+    while True:
+      with node_results.lock:
+        if index < len(node_results.objects):
+          obj = node_results.objects[index]
+        elif node_results.source is None:
+          return
+        else:
+          try:
+            obj = next(node_results.source)
+          except StopIteration:
+            node_results.source = None
+            return
+          except Exception:
+            # failed resolution is not cached
+            with self._lock:
+              if self._cache.get(key) is node_results:
+                del self._cache[key]
+            raise
+          node_results.objects.append(obj)
+      index += 1
+      yield obj
+
+
+def iter_node_objects(node: Node, management_object: ManagementObject) -> Iterator[ManagementObject]:
+  """
+  Resolves node for given object, uses active 'TraversalSession' if there is any.
+  """
+  session = TraversalSession.current()
+  if session is not None:
+    return session.iter_node_objects(node, management_object)
+  return node.iter_node_objects(management_object)
+
+
+def iter_traverse(traverse_path: Sequence[Node], parent: 'ManagementObject') -> Iterator[Tuple[ManagementObject, ...]]:
+  """
+  Lazily yields all paths from ``parent`` through given nodes. Next level is resolved only when consumer asks for next
+  path, so consumers that stop early do not issue queries for the rest of hierarchy.
+
+  :param traverse_path: nodes to traverse
+  :param parent: object to start from
+  :return: iterator over found paths
+  """
+  if not traverse_path:
+    return
+  depth = len(traverse_path)
+  # path holds current objects of all levels above the deepest active iterator
+  path = []
+  iterators = [iter_node_objects(traverse_path[0], parent)]
+  try:
+    while iterators:
+      try:
+        obj = next(iterators[-1])
+      except StopIteration:
+        iterators.pop()
+        if path:
+          path.pop()
+        continue
+      if len(iterators) == depth:
+        yield tuple(path) + (obj,)
+      else:
+        path.append(obj)
+        iterators.append(iter_node_objects(traverse_path[len(iterators)], obj))
+  finally:
+    for iterator in iterators:
+      close = getattr(iterator, 'close', None)
+      if close is not None:
+        close()
+
+
+def first(paths: Iterator[Tuple[ManagementObject, ...]]):
+  """
+  Returns first of given paths, or ``None`` if there are no paths. Stops traversal right after first path is found.
+  """
+  try:
+    return next(iter(paths), None)
+  finally:
+    close = getattr(paths, 'close', None)
+    if close is not None:
+      close()
+
+
+def only(paths: Iterator[Tuple[ManagementObject, ...]]):
+  """
+  Returns the only one of given paths. Stops traversal as soon as second path is found.
+
+  :raise LookupError: if there are no paths or more than one path
+  """
+  paths = iter(paths)
+  try:
+    result = next(paths, None)
+    if result is None:
+      raise LookupError("No child found for given path")
+    if next(paths, None) is not None:
+      raise LookupError("Found more that one child for given path")
+    return result
+  finally:
+    close = getattr(paths, 'close', None)
+    if close is not None:
+      close()
+
+
+def leaves(paths: Iterator[Tuple[ManagementObject, ...]]) -> Iterator[ManagementObject]:
+  """
+  Yields last object of every given path.
+  """
+  for path in paths:
+    yield path[-1]
 
 
 def recursive_traverse(traverse_path: Sequence[Node], parent: 'ManagementObject'):
-  results = []
-  if len(traverse_path) == 1:
-    for obj in traverse_path[0].get_node_objects(parent):
-      results.append([obj])
-    return results
-  else:
-    for obj in traverse_path[0].get_node_objects(parent):
-      for children in recursive_traverse(traverse_path[1:], obj):
-        cur_res = [obj]
-        cur_res.extend(children)
-        results.append(cur_res)
-    return results
+  return [list(path) for path in iter_traverse(traverse_path, parent)]
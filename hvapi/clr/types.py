@@ -40,6 +40,25 @@ class Msvm_ConcreteJob_JobState(RangedCodeEnum):
   Vendor_Reserved = (32768, 65535)
 
 
+class ResourceSubType(str, Enum):
+  """
+  Values of 'ResourceSubType' property of primordial resource pools and their allocation settings.
+  """
+  Processor = 'Microsoft:Hyper-V:Processor'
+  Memory = 'Microsoft:Hyper-V:Memory'
+  SyntheticEthernetPort = 'Microsoft:Hyper-V:Synthetic Ethernet Port'
+  EmulatedEthernetPort = 'Microsoft:Hyper-V:Emulated Ethernet Port'
+  EthernetConnection = 'Microsoft:Hyper-V:Ethernet Connection'
+  EmulatedIDEController = 'Microsoft:Hyper-V:Emulated IDE Controller'
+  SyntheticSCSIController = 'Microsoft:Hyper-V:Synthetic SCSI Controller'
+  SyntheticDiskDrive = 'Microsoft:Hyper-V:Synthetic Disk Drive'
+  SyntheticDVDDrive = 'Microsoft:Hyper-V:Synthetic DVD Drive'
+  VirtualHardDisk = 'Microsoft:Hyper-V:Virtual Hard Disk'
+  VirtualCDDVDDisk = 'Microsoft:Hyper-V:Virtual CD/DVD Disk'
+  SerialController = 'Microsoft:Hyper-V:Serial Controller'
+  SerialPort = 'Microsoft:Hyper-V:Serial Port'
+
+
 class VirtualMachineStateInternal(str, Enum):
   Other = 'Other'
   Running = 'Running'
@@ -234,5 +253,21 @@ class VSMS_AddResourceSettings_ReturnCode(RangedCodeEnum):
   Vendor_Specific = (32768, 65535)
 
 
+class VSMS_RemoveResourceSettings_ReturnCode(RangedCodeEnum):
+  """
+  VirtualSystemManagementService RemoveResourceSettings method return codes.
+  """
+  Completed_with_No_Error = 0
+  Not_Supported = 1
+  Failed = 2
+  Timeout = 3
+  Invalid_Parameter = 4
+  Invalid_State = 5
+  # DMTF_Reserved = ?
+  Method_Parameters_Checked_Job_Started = 4096
+  Method_Reserved = (4097, 32767)
+  Vendor_Specific = (32768, 65535)
+
+
 class InvocationException(Exception):
   pass
\ No newline at end of file
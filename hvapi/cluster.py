@@ -0,0 +1,335 @@
+# The MIT License
+#
+# Copyright (c) 2017 Eugene Chekanskiy, echekanskiy@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import itertools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Sequence, Union
+
+from hvapi.clr.imports import ConnectionOptions
+from hvapi.clr.scope import ScopeBound, tag_connection
+from hvapi._private import is_connection_error
+from hvapi.hyperv import HypervHost
+from hvapi.types import NotFoundException
+
+DEFAULT_CONNECTIONS_PER_HOST = 2
+DEFAULT_MAX_WORKERS = 16
+
+
+class HostResult(object):
+  """
+  Result of operation executed on one host of cluster.
+  """
+  __slots__ = ('host', 'value', 'error', 'elapsed')
+
+  def __init__(self, host, value=None, error=None, elapsed=None):
+    self.host = host
+    self.value = value
+    self.error = error
+    self.elapsed = elapsed
+
+  @property
+  def ok(self) -> bool:
+    return self.error is None
+
+  def __repr__(self):
+    return "HostResult(host=%r, value=%r, error=%r, elapsed=%r)" % (self.host, self.value, self.error, self.elapsed)
+
+
+class ClusterResult(object):
+  """
+  Merged results of operation executed on all hosts of cluster. Errors are isolated per host, failure of one host does
+  not affect results of others.
+  """
+
+  def __init__(self, host_results: Sequence[HostResult]):
+    self.host_results = {host_result.host: host_result for host_result in host_results}
+
+  @property
+  def results(self) -> Dict[str, Any]:
+    return {host: result.value for host, result in self.host_results.items() if result.ok}
+
+  @property
+  def errors(self) -> Dict[str, Exception]:
+    return {host: result.error for host, result in self.host_results.items() if not result.ok}
+
+  @property
+  def ok(self) -> bool:
+    return all(result.ok for result in self.host_results.values())
+
+  def merged(self) -> Union[list, dict]:
+    """
+    Merges results of all hosts that completed successfully. List results are concatenated, dict results are updated
+    into one dict. Hosts that gave ``None`` are skipped.
+    """
+    values = [value for value in self.results.values() if value is not None]
+    if values and all(isinstance(value, dict) for value in values):
+      merged = {}
+      for value in values:
+        merged.update(value)
+      return merged
+    merged = []
+    for value in values:
+      if not isinstance(value, list):
+        raise TypeError("Only list or dict results can be merged, got '%s'" % type(value).__name__)
+      merged.extend(value)
+    return merged
+
+  def __getitem__(self, host) -> HostResult:
+    return self.host_results[host]
+
+  def __repr__(self):
+    return "ClusterResult(results=%r, errors=%r)" % (self.results, self.errors)
+
+
+class HostPool(object):
+  """
+  Pool of connected 'HypervHost' instances for one host. Every instance is used by one thread at a time and has its
+  own connection tag, so it does not share services and caches with other instances, see 'tag_connection'.
+  """
+
+  def __init__(self, host, size=DEFAULT_CONNECTIONS_PER_HOST, options: ConnectionOptions = None):
+    """
+    :param host: host name
+    :param size: max number of connections
+    :param options: connection options
+    """
+    self.host = host
+    self.size = size
+    self.options = options
+    self._idle = queue.LifoQueue()
+    self._created = 0
+    self._tags = itertools.count()
+    self._lock = threading.Lock()
+    self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="hvapi-cluster-%s" % host)
+
+  def _create(self) -> HypervHost:
+    hyperv_host = HypervHost(self.host, tag_connection(self.options, next(self._tags)))
+    hyperv_host.scope.Connect()
+    return hyperv_host
+
+  @contextmanager
+  def acquire(self, timeout=None):
+    """
+    Gives connected 'HypervHost' for exclusive usage, creates new connection if pool is not full yet.
+
+    :param timeout: seconds to wait for free connection
+    """
+    hyperv_host = self.get(timeout)
+    try:
+      yield hyperv_host
+    except Exception as e:
+      self.release(hyperv_host, broken=is_connection_error(e))
+      raise
+    else:
+      self.release(hyperv_host)
+
+  def get(self, timeout=None) -> HypervHost:
+    """
+    Takes connected 'HypervHost' from pool, it must be returned by 'release'.
+
+    :param timeout: seconds to wait for free connection
+    """
+    with self._lock:
+      if self._idle.empty() and self._created < self.size:
+        self._created += 1
+        create = True
+      else:
+        create = False
+    if create:
+      try:
+        return self._create()
+      except Exception:
+        with self._lock:
+          self._created -= 1
+        raise
+    try:
+      return self._idle.get(timeout=timeout)
+    except queue.Empty:
+      raise TimeoutError("No free connection to host '%s' in %s seconds" % (self.host, timeout)) from None
+
+  def release(self, hyperv_host: HypervHost, broken=False):
+    """
+    Returns 'HypervHost' taken by 'get' to pool. Broken instance is dropped, it will be replaced with new one.
+    """
+    if broken:
+      ScopeBound.discard_scope(hyperv_host.scope)
+      with self._lock:
+        self._created -= 1
+    else:
+      self._idle.put(hyperv_host)
+
+  def call(self, func: Callable[[HypervHost], Any], timeout):
+    """
+    Executes ``func`` with pooled 'HypervHost' on executor of this pool, it has one worker per connection. Running call
+    can not be interrupted, so it is abandoned when deadline is reached: its 'HypervHost' stays taken until worker
+    finishes and then it is dropped from pool instead of being reused.
+
+    :param timeout: seconds to wait for free connection and for ``func`` to complete
+    """
+    deadline = time.monotonic() + timeout
+    hyperv_host = self.get(timeout)
+    lock = threading.Lock()
+    abandoned = False
+
+    def _done(future):
+      error = future.exception()
+      with lock:
+        broken = abandoned or (error is not None and is_connection_error(error))
+      self.release(hyperv_host, broken=broken)
+
+    try:
+      future = self._executor.submit(func, hyperv_host)
+    except Exception:
+      self.release(hyperv_host)
+      raise
+    future.add_done_callback(_done)
+    wait((future,), max(deadline - time.monotonic(), 0))
+    with lock:
+      abandoned = not future.done()
+    if abandoned:
+      raise TimeoutError("Operation on host '%s' did not complete in %s seconds" % (self.host, timeout))
+    return future.result()
+
+  def close(self):
+    self._executor.shutdown(wait=False)
+
+
+class HypervCluster(object):
+  """
+  Gives access to many Hyper-V hosts at once. Operations are executed on all hosts in parallel on bounded thread pool,
+  so they take about as long as on the slowest host. Results are merged into 'ClusterResult' with per-host errors.
+
+  Example::
+
+    with HypervCluster(["hv01", "hv02"], options=connection_options(timeout=30)) as cluster:
+      result = cluster.machines
+      for machine in result.merged():
+        print(machine.name)
+      for host, error in result.errors.items():
+        print("%s failed: %s" % (host, error))
+  """
+  LOG = logging.getLogger('%s.%s' % (__module__, __qualname__))
+
+  def __init__(self, hosts: Sequence[str], connections_per_host=DEFAULT_CONNECTIONS_PER_HOST,
+               max_workers=DEFAULT_MAX_WORKERS, options: ConnectionOptions = None, timeout=None):
+    """
+    :param hosts: host names
+    :param connections_per_host: max number of connections to one host
+    :param max_workers: max number of operations executed at once for all hosts
+    :param options: connection options for all hosts, see 'hvapi.clr.base.connection_options'
+    :param timeout: default timeout in seconds for operation on one host
+    """
+    self.pools = {host: HostPool(host, connections_per_host, options) for host in hosts}
+    self.timeout = timeout
+    self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+  @property
+  def hosts(self) -> List[str]:
+    return list(self.pools)
+
+  def _run(self, host, func: Callable[[HypervHost], Any], timeout) -> HostResult:
+    _start = time.monotonic()
+    try:
+      return HostResult(host, value=self._call(host, func, timeout), elapsed=time.monotonic() - _start)
+    except Exception as e:
+      self.LOG.debug("Operation failed on host '%s': %s", host, e)
+      return HostResult(host, error=e, elapsed=time.monotonic() - _start)
+
+  def _call(self, host, func: Callable[[HypervHost], Any], timeout):
+    """
+    Executes ``func`` with pooled 'HypervHost'. Deadline starts when execution for host starts, not when operation is
+    submitted, see 'HostPool.call'.
+    """
+    pool = self.pools[host]
+    if timeout is None:
+      with pool.acquire() as hyperv_host:
+        return func(hyperv_host)
+    return pool.call(func, timeout)
+
+  def map(self, func: Callable[[HypervHost], Any], hosts: Sequence[str] = None, timeout=None) -> ClusterResult:
+    """
+    Executes ``func`` for every host in parallel.
+
+    :param func: callable that accepts 'HypervHost'
+    :param hosts: hosts to use, all hosts by default
+    :param timeout: seconds given to each host from start of its execution, time spent in queue waiting for free worker
+      is not counted. Hosts that did not complete in time get 'TimeoutError'
+    :return: merged results
+    """
+    timeout = self.timeout if timeout is None else timeout
+    hosts = self.hosts if hosts is None else hosts
+    futures = [self._executor.submit(self._run, host, func, timeout) for host in hosts]
+    return ClusterResult([future.result() for future in futures])
+
+  @property
+  def machines(self) -> ClusterResult:
+    return self.map(lambda hyperv_host: hyperv_host.machines)
+
+  def list_machines(self, fields: Sequence[str] = None) -> ClusterResult:
+    return self.map(lambda hyperv_host: hyperv_host.list_machines(fields))
+
+  @property
+  def switches(self) -> ClusterResult:
+    return self.map(lambda hyperv_host: hyperv_host.switches)
+
+  def list_switches(self, fields: Sequence[str] = None) -> ClusterResult:
+    return self.map(lambda hyperv_host: hyperv_host.list_switches(fields))
+
+  def inventory(self) -> ClusterResult:
+    return self.map(lambda hyperv_host: hyperv_host.inventory())
+
+  def machine_by_name(self, name, fields: Sequence[str] = None) -> ClusterResult:
+    """
+    Looks for machine on all hosts. Hosts that do not have such machine give ``None``.
+    """
+    return self.map(lambda hyperv_host: _not_found_to_none(hyperv_host.machine_by_name, name, fields))
+
+  def machine_by_id(self, machine_id, fields: Sequence[str] = None) -> ClusterResult:
+    """
+    Looks for machine on all hosts. Hosts that do not have such machine give ``None``.
+    """
+    return self.map(lambda hyperv_host: _not_found_to_none(hyperv_host.machine_by_id, machine_id, fields))
+
+  def switch_by_name(self, name, fields: Sequence[str] = None) -> ClusterResult:
+    return self.map(lambda hyperv_host: _not_found_to_none(hyperv_host.switch_by_name, name, fields))
+
+  def close(self):
+    self._executor.shutdown(wait=False)
+    for pool in self.pools.values():
+      pool.close()
+
+  def __enter__(self) -> 'HypervCluster':
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+
+def _not_found_to_none(lookup, key, fields):
+  try:
+    return lookup(key, fields)
+  except NotFoundException:
+    return None
@@ -19,23 +19,54 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
-import collections
-from enum import Enum
+from bisect import bisect_right
+from collections.abc import Iterable
+from enum import Enum, EnumMeta
 
 
-class RangedCodeEnum(Enum):
+class RangedCodeEnumMeta(EnumMeta):
+  """
+  Builds code lookup tables when enum class is defined: dict for exact codes and sorted table of disjoint intervals
+  for ranged members, e.g. ``DMTF_Reserved = (12, 32767)``. If code matches several members, first defined member
+  wins.
+  """
+
+  def __new__(mcs, *args, **kwargs):
+    enum_class = super().__new__(mcs, *args, **kwargs)
+    codes = {}
+    ranges = []
+    for enum_item in enum_class:
+      enum_val = enum_item.value
+      if isinstance(enum_val, Iterable) and len(enum_val) != 1:
+        start, end = enum_val
+        for _start, _end, _ in ranges:
+          if start <= _end and _start <= end:
+            raise TypeError("Ranges of '%s' overlap: (%s, %s) and (%s, %s)" % (
+              enum_class.__name__, _start, _end, start, end))
+        ranges.append((start, end, enum_item))
+      else:
+        code = enum_val[0] if isinstance(enum_val, Iterable) else enum_val
+        if code not in codes and not any(start <= code <= end for start, end, _ in ranges):
+          codes[code] = enum_item
+    ranges.sort(key=lambda _range: _range[0])
+    type.__setattr__(enum_class, '_codes_table_', codes)
+    type.__setattr__(enum_class, '_ranges_starts_', [start for start, _, _ in ranges])
+    type.__setattr__(enum_class, '_ranges_table_', ranges)
+    return enum_class
+
+
+class RangedCodeEnum(Enum, metaclass=RangedCodeEnumMeta):
   @classmethod
   def from_code(cls, value):
-    for enum_item in cls:
-      enum_val = enum_item.value
-      if isinstance(enum_val, collections.Iterable):
-        if len(enum_val) == 1:
-          if enum_val[0] == value:
-            return enum_item
-        elif enum_val[0] <= value <= enum_val[1]:
-          return enum_item
-      elif enum_val == value:
+    enum_item = cls._codes_table_.get(value)
+    if enum_item is not None or not cls._ranges_table_ or not isinstance(value, int):
+      return enum_item
+    index = bisect_right(cls._ranges_starts_, value) - 1
+    if index >= 0:
+      start, end, enum_item = cls._ranges_table_[index]
+      if value <= end:
         return enum_item
+    return None
 
 
 def opencls(cls):
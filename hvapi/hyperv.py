@@ -21,21 +21,30 @@
 # THE SOFTWARE.
 import logging
 import time
-from typing import List, Dict, Any
-
-from hvapi._private import VirtualSystemManagementService, MOWrapper
-from hvapi.clr.base import generate_guid, ManagementScope
-from hvapi.clr.imports import clr_Array, clr_String
-from hvapi.clr.invoke import evaluate_invocation_result
-from hvapi.clr.traversal import ReferenceTransformer, PropertiesSelector, PropertyNode, RelatedNode, RelationshipNode, \
-  VirtualSystemSettingDataNode
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from contextlib import closing
+from functools import partial
+from itertools import islice
+from typing import List, Dict, Any, Sequence, Union
+
+from hvapi._private import MOWrapper, ServiceLocator, SettingsTemplates, ComputerSystemEvents, MachineStateTable, \
+  MachineStateEntry, path_key
+from hvapi.clr.base import generate_guid, ManagementObject, ManagementScope, ObjectRecord, select_query
+from hvapi.clr.imports import clr_Array, clr_String, ConnectionOptions
+from hvapi.clr.invoke import DEFAULT_JOB_TIMEOUT, evaluate_invocation_result
+from hvapi.clr.scope import ObjectFactory
+from hvapi.clr.traversal import ReferenceTransformer, PropertyNode, RelatedNode, \
+  ComponentSettingsNode, VirtualSystemSettingDataNode, TraversalSession, leaves
 from hvapi.clr.types import (ComputerSystem_RequestStateChange_RequestedState,
                              ComputerSystem_RequestStateChange_ReturnCodes, ComputerSystem_EnabledState,
-                             ShutdownComponent_OperationalStatus, ShutdownComponent_ShutdownComponent_ReturnCodes)
+                             ShutdownComponent_OperationalStatus, ShutdownComponent_ShutdownComponent_ReturnCodes,
+                             ResourceSubType, InvocationException)
 from hvapi.disk.vhd import VHDDisk
 from hvapi.types import VirtualMachineGeneration, VirtualMachineState, ComPort, NotFoundException, TooManyResultsException
+from hvapi.wait import Backoff, CancellationToken, WaitTimeoutError, wait_until
 
 DEFAULT_WAIT_OP_TIMEOUT = 60
+DEFAULT_POWER_CONCURRENCY = 8
 
 
 class VirtualSwitch(MOWrapper):
@@ -69,13 +78,15 @@ class AdapterGuestSettings(MOWrapper):
     return self.properties['IPAddresses']
 
   def set_ip_settings(self, dhcp=True, ip=[], sub_nets=[], gateways=[], dns=[]):
-    management_service = VirtualSystemManagementService(self.Scope.query_one('SELECT * FROM Msvm_VirtualSystemManagementService'))
-    self.properties.DHCPEnabled = dhcp
-    self.properties.IPAddresses = ip
-    self.properties.Subnets = sub_nets
-    self.properties.DefaultGateways = gateways
-    self.properties.DNSServers = dns
-    self.properties.ProtocolIFType = 4096
+    management_service = self.services.management_service
+    settings = self.snapshot()
+    settings.DHCPEnabled = dhcp
+    settings.IPAddresses = ip
+    settings.Subnets = sub_nets
+    settings.DefaultGateways = gateways
+    settings.DNSServers = dns
+    settings.ProtocolIFType = 4096
+    settings.flush()
     computer_system = self.parent.parent
     management_service.SetGuestNetworkAdapterConfiguration(computer_system, self)
 
@@ -89,13 +100,11 @@ class VirtualNetworkAdapter(MOWrapper):
 
   @property
   def switch(self) -> 'VirtualSwitch':
-    result = []
     port_to_switch_path = (
       RelatedNode(("Msvm_EthernetPortAllocationSettingData",)),
       PropertyNode("HostResource", transformer=ReferenceTransformer())
     )
-    for _, virtual_switch in self.traverse(port_to_switch_path):
-      result.append(VirtualSwitch(virtual_switch))
+    result = [VirtualSwitch(virtual_switch) for virtual_switch in islice(leaves(self.iter_traverse(port_to_switch_path)), 2)]
     if len(result) > 1:
       raise Exception("Something horrible happened, virtual network adapter connected to more that one virtual switch")
     if result:
@@ -119,16 +128,9 @@ class VirtualNetworkAdapter(MOWrapper):
 
     :param virtual_switch: virtual switch to connect
     """
-    management_service = VirtualSystemManagementService(self.Scope.query_one('SELECT * FROM Msvm_VirtualSystemManagementService'))
-    Msvm_VirtualSystemSettingData = self.traverse((RelatedNode(("Msvm_VirtualSystemSettingData",)),))[-1][-1]
-    Msvm_ResourcePool = self.Scope.query_one("SELECT * FROM Msvm_ResourcePool WHERE ResourceSubType = 'Microsoft:Hyper-V:Ethernet Connection' AND Primordial = True")
-    Msvm_EthernetPortAllocationSettingData_Path = (
-      RelatedNode(("Msvm_AllocationCapabilities", "Msvm_ElementCapabilities", None, None, None, None, False, None)),
-      RelationshipNode(("Msvm_SettingsDefineCapabilities",), selector=PropertiesSelector(ValueRole=0)),
-      PropertyNode("PartComponent", transformer=ReferenceTransformer())
-    )
-    Msvm_EthernetPortAllocationSettingData = \
-      Msvm_ResourcePool.traverse(Msvm_EthernetPortAllocationSettingData_Path)[-1][-1]
+    management_service = self.services.management_service
+    Msvm_VirtualSystemSettingData = self.first_child((RelatedNode(("Msvm_VirtualSystemSettingData",)),))
+    Msvm_EthernetPortAllocationSettingData = self.templates.get(ResourceSubType.EthernetConnection)
     Msvm_EthernetPortAllocationSettingData.properties.Parent = self
     Msvm_EthernetPortAllocationSettingData.properties.HostResource = [virtual_switch]
     management_service.AddResourceSettings(Msvm_VirtualSystemSettingData, Msvm_EthernetPortAllocationSettingData)
@@ -148,7 +150,7 @@ class VirtualComPort(MOWrapper):
 
   @path.setter
   def path(self, value):
-    management_service = VirtualSystemManagementService(self.Scope.query_one('SELECT * FROM Msvm_VirtualSystemManagementService'))
+    management_service = self.services.management_service
     self.properties.Connection = [value]
     management_service.ModifyResourceSettings(self)
 
@@ -156,13 +158,15 @@ class VirtualComPort(MOWrapper):
 class ShutdownComponent(MOWrapper):
   MO_CLS = 'Msvm_ShutdownComponent'
 
-  def InitiateShutdown(self, Force, Reason):
+  def InitiateShutdown(self, Force, Reason, wait=True, timeout=DEFAULT_JOB_TIMEOUT):
     out_objects = self.invoke("InitiateShutdown", Force=Force, Reason=Reason)
     return evaluate_invocation_result(
       out_objects,
       ShutdownComponent_ShutdownComponent_ReturnCodes,
       ShutdownComponent_ShutdownComponent_ReturnCodes.Completed_with_No_Error,
-      ShutdownComponent_ShutdownComponent_ReturnCodes.Method_Parameters_Checked_JobStarted
+      ShutdownComponent_ShutdownComponent_ReturnCodes.Method_Parameters_Checked_JobStarted,
+      wait,
+      timeout
     )
 
 # TODO expose cpu, memory, etc settings via properties
@@ -199,10 +203,8 @@ class VirtualMachine(MOWrapper):
     :param class_name: class name that will be used for modification
     :param properties: properties to apply
     """
-    management_service = VirtualSystemManagementService(self.Scope.query_one('SELECT * FROM Msvm_VirtualSystemManagementService'))
-    class_instance = self.traverse(self.PATH_MAP[class_name])[0][-1]
-    for property_name, property_value in properties.items():
-      setattr(class_instance.properties, property_name, property_value)
+    management_service = self.services.management_service
+    class_instance = self._updated_settings(class_name, properties)
     if class_name in self.RESOURCE_CLASSES:
       management_service.ModifyResourceSettings(class_instance)
     if class_name in self.SYSTEM_CLASSES:
@@ -210,13 +212,39 @@ class VirtualMachine(MOWrapper):
 
   def apply_properties_group(self, properties_group: Dict[str, Dict[str, Any]]):
     """
-    Applies given properties to virtual machine.
+    Applies given properties to virtual machine. All resource classes are modified by one 'ModifyResourceSettings'
+    call and system settings by at most one 'ModifySystemSettings' call, calls are ordered by priority of their classes.
 
     :param properties_group: dict of classes and their properties
     """
-    if properties_group:
-      for cls, properties in sorted(properties_group.items(), key=lambda itm: self._CLS_MAP_PRIORITY.get(itm[0], 100)):
-        self.apply_properties(cls, properties)
+    if not properties_group:
+      return
+    calls = {}
+    with TraversalSession():
+      for cls, properties in properties_group.items():
+        if cls in self.SYSTEM_CLASSES:
+          kind = "system"
+        elif cls in self.RESOURCE_CLASSES:
+          kind = "resource"
+        else:
+          raise ValueError("Unknown settings class '%s'" % cls)
+        priority, settings = calls.get(kind, (100, []))
+        settings.append(self._updated_settings(cls, properties))
+        calls[kind] = (min(priority, self._CLS_MAP_PRIORITY.get(cls, 100)), settings)
+    management_service = self.services.management_service
+    for kind, (_, settings) in sorted(calls.items(), key=lambda itm: itm[1][0]):
+      if kind == "system":
+        for system_settings in settings:
+          management_service.ModifySystemSettings(SystemSettings=system_settings)
+      else:
+        management_service.ModifyResourceSettings(*settings)
+
+  def _updated_settings(self, class_name: str, properties: Dict[str, Any]):
+    class_instance = self.first_child(self.PATH_MAP[class_name])
+    settings = class_instance.snapshot()
+    settings.update(properties)
+    settings.flush()
+    return class_instance
 
   @property
   def name(self) -> str:
@@ -239,96 +267,119 @@ class VirtualMachine(MOWrapper):
   @property
   def state(self) -> VirtualMachineState:
     """
-    Current virtual machine state. It will try to get actual real state(like running, stopped, etc) for
-    ``DEFAULT_WAIT_OP_TIMEOUT`` seconds before returning ``VirtualMachineState.UNDEFINED``. We need this
-    ``DEFAULT_WAIT_OP_TIMEOUT`` because hyper-v likes some middle states, like starting, stopping, etc.
-    Usually this middle states long not more that 10 seconds and soon will changed to something that we expecting.
+    Current virtual machine state, see ``get_state``.
+
+    :return: virtual machine state
+    """
+    return self.get_state()
 
+  def get_state(self, timeout=DEFAULT_WAIT_OP_TIMEOUT, token: CancellationToken = None) -> VirtualMachineState:
+    """
+    Current virtual machine state. It will try to get actual real state(like running, stopped, etc) for ``timeout``
+    seconds before returning ``VirtualMachineState.UNDEFINED``. We need this ``timeout`` because hyper-v likes some
+    middle states, like starting, stopping, etc. Usually this middle states long not more that 10 seconds and soon
+    will changed to something that we expecting. If host state table is watched(see ``HypervHost.watch``) and it knows
+    settled state of machine, state is returned from table without any round trip.
+
+    :param timeout: seconds to wait for settled state
+    :param token: cancellation token
     :return: virtual machine state
     """
-    _start = time.time()
-    state = self._enabled_state.to_virtual_machine_state()
-    while state == VirtualMachineState.UNDEFINED and time.time() - _start < DEFAULT_WAIT_OP_TIMEOUT:
-      state = self._enabled_state.to_virtual_machine_state()
-      time.sleep(.1)
-    return state
+    # key is taken from path, reading 'Name' property would load whole object
+    machine_id = path_key(self.Path, 'Name') or self.id
+    table = MachineStateTable.for_scope(self.Scope)
+    if table.active:
+      entry = table.get(machine_id)
+      if entry is not None and entry.enabled_state.to_virtual_machine_state() != VirtualMachineState.UNDEFINED:
+        return entry.enabled_state.to_virtual_machine_state()
+    enabled_state = self.events.wait_for_state(
+      machine_id,
+      lambda _state: _state.to_virtual_machine_state() != VirtualMachineState.UNDEFINED,
+      lambda: self._enabled_state,
+      timeout,
+      token=token
+    )
+    return enabled_state.to_virtual_machine_state()
 
-  def start(self):
+  def start(self, timeout=DEFAULT_WAIT_OP_TIMEOUT, token: CancellationToken = None):
     """
     Try to start virtual machine and wait for started state for ``timeout`` seconds.
     """
-    if self.state != VirtualMachineState.RUNNING:
+    deadline = _deadline(timeout)
+    if self.get_state(_remaining(deadline), token) != VirtualMachineState.RUNNING:
       self.LOG.debug("Starting machine '%s'", self.id)
-      desired_state = ComputerSystem_RequestStateChange_RequestedState.Running
-      target_enabled_state = desired_state.to_ComputerSystem_EnabledState()
-      self.RequestStateChange(desired_state)
-      if not self._wait_for_enabled_state(target_enabled_state, timeout=DEFAULT_WAIT_OP_TIMEOUT):
-        raise Exception("Failed to put machine to '%s' in %s seconds" % (target_enabled_state, DEFAULT_WAIT_OP_TIMEOUT))
+      self._change_state(ComputerSystem_RequestStateChange_RequestedState.Running, timeout, deadline, token)
       self.LOG.debug("Started machine '%s'", self.id)
     else:
       self.LOG.debug("Machine '%s' is already started", self.id)
 
-  def stop(self, force=False, hard=False):
+  def stop(self, force=False, hard=False, timeout=DEFAULT_WAIT_OP_TIMEOUT, token: CancellationToken = None):
     """
     Try to stop virtual machine and wait for stopped state for ``timeout`` seconds.
 
     :param force: indicates if we need to wait for user programs completion, ignored if *force* is *True*
     :param hard: indicates if we need to perform turn off(power off)
+    :param timeout: seconds to wait for graceful stop and then for kill
+    :param token: cancellation token
     """
     self.LOG.debug("Stopping machine '%s'", self.id)
+    deadline = _deadline(timeout)
     desired_state = ComputerSystem_RequestStateChange_RequestedState.Off
     target_enabled_state = desired_state.to_ComputerSystem_EnabledState()
     if not hard:
       shutdown_component = self._get_shutdown_component()
       if shutdown_component:
-        shutdown_component.InitiateShutdown(force, "hvapi shutdown")
-        if not self._wait_for_enabled_state(target_enabled_state, timeout=DEFAULT_WAIT_OP_TIMEOUT):
+        try:
+          _wait_invocation(shutdown_component.InitiateShutdown(force, "hvapi shutdown", wait=False), deadline, token)
+          stopped = self._wait_for_enabled_state(target_enabled_state, _remaining(deadline), token)
+        except WaitTimeoutError:
+          stopped = False
+        if not stopped:
           self.LOG.debug("Failed to stop machine '%s' gracefully, killing...", self.id)
-          self.kill()
+          self.kill(timeout, token)
       else:
         self.LOG.debug("Graceful stop for machine '%s' not available, killing...", self.id)
-        self.kill()
+        self.kill(timeout, token)
     else:
-      self.kill()
+      self.kill(timeout, token)
     self.LOG.debug("Stopped machine '%s'", self.id)
 
-  def kill(self):
+  def kill(self, timeout=DEFAULT_WAIT_OP_TIMEOUT, token: CancellationToken = None):
     """
     Hard-kill vm.
     """
-    desired_state = ComputerSystem_RequestStateChange_RequestedState.Off
-    target_enabled_state = desired_state.to_ComputerSystem_EnabledState()
-    self.RequestStateChange(desired_state)
-    if not self._wait_for_enabled_state(target_enabled_state, timeout=DEFAULT_WAIT_OP_TIMEOUT):
-      raise Exception("Failed to put machine to '%s' in %s seconds" % (target_enabled_state, DEFAULT_WAIT_OP_TIMEOUT))
+    self._change_state(ComputerSystem_RequestStateChange_RequestedState.Off, timeout, _deadline(timeout), token)
 
-  def save(self):
+  def save(self, timeout=DEFAULT_WAIT_OP_TIMEOUT, token: CancellationToken = None):
     """
     Try to save virtual machine state and wait for saved state for ``timeout`` seconds.
     """
-    if self.state != VirtualMachineState.SAVED:
+    deadline = _deadline(timeout)
+    if self.get_state(_remaining(deadline), token) != VirtualMachineState.SAVED:
       self.LOG.debug("Saving machine '%s'", self.id)
-      desired_state = ComputerSystem_RequestStateChange_RequestedState.Saved
-      target_enabled_state = desired_state.to_ComputerSystem_EnabledState()
-      self.RequestStateChange(desired_state)
-      if not self._wait_for_enabled_state(target_enabled_state, timeout=DEFAULT_WAIT_OP_TIMEOUT):
-        raise Exception("Failed to put machine to '%s' in %s seconds" % (target_enabled_state, DEFAULT_WAIT_OP_TIMEOUT))
+      self._change_state(ComputerSystem_RequestStateChange_RequestedState.Saved, timeout, deadline, token)
       self.LOG.debug("Saved machine '%s'", self.id)
     else:
       self.LOG.debug("Machine '%s' is already saved", self.id)
 
-  def pause(self):
-    if self.state != VirtualMachineState.PAUSED:
+  def pause(self, timeout=DEFAULT_WAIT_OP_TIMEOUT, token: CancellationToken = None):
+    """
+    Try to pause virtual machine and wait for paused state for ``timeout`` seconds.
+    """
+    deadline = _deadline(timeout)
+    if self.get_state(_remaining(deadline), token) != VirtualMachineState.PAUSED:
       self.LOG.debug("Pausing machine '%s'", self.id)
-      desired_state = ComputerSystem_RequestStateChange_RequestedState.Paused
-      target_enabled_state = desired_state.to_ComputerSystem_EnabledState()
-      self.RequestStateChange(desired_state)
-      if not self._wait_for_enabled_state(target_enabled_state, timeout=DEFAULT_WAIT_OP_TIMEOUT):
-        raise Exception("Failed to put machine to '%s' in %s seconds" % (target_enabled_state, DEFAULT_WAIT_OP_TIMEOUT))
+      self._change_state(ComputerSystem_RequestStateChange_RequestedState.Paused, timeout, deadline, token)
       self.LOG.debug("Paused machine '%s'", self.id)
     else:
       self.LOG.debug("Machine '%s' is already paused", self.id)
 
+  def devices(self) -> 'DeviceBuilder':
+    """
+    Returns builder that adds many devices with minimal number of calls, see ``DeviceBuilder``.
+    """
+    return DeviceBuilder(self)
+
   def add_adapter(self, static_mac=False, mac=None, adapter_name="Network Adapter") -> 'VirtualNetworkAdapter':
     """
     Add adapter to virtual machine.
@@ -338,27 +389,9 @@ class VirtualMachine(MOWrapper):
     :param adapter_name: adapter name
     :return: created adapter
     """
-    management_service = VirtualSystemManagementService(self.Scope.query_one('SELECT * FROM Msvm_VirtualSystemManagementService'))
-    Msvm_ResourcePool = self.Scope.query_one(
-      "SELECT * FROM Msvm_ResourcePool WHERE ResourceSubType = 'Microsoft:Hyper-V:Synthetic Ethernet Port' "
-      "AND Primordial = True"
-    )
-    Msvm_SyntheticEthernetPortSettingData_Path = (
-      RelatedNode(("Msvm_AllocationCapabilities", "Msvm_ElementCapabilities", None, None, None, None, False, None)),
-      RelationshipNode(("Msvm_SettingsDefineCapabilities",), selector=PropertiesSelector(ValueRole=0)),
-      PropertyNode("PartComponent", transformer=ReferenceTransformer())
-    )
-    Msvm_VirtualSystemSettingData = self.traverse((VirtualSystemSettingDataNode,))[-1][-1]
-    Msvm_SyntheticEthernetPortSettingData = Msvm_ResourcePool.traverse(Msvm_SyntheticEthernetPortSettingData_Path)[-1][
-      -1]
-    Msvm_SyntheticEthernetPortSettingData.properties.VirtualSystemIdentifiers = clr_Array[clr_String]([generate_guid()])
-    Msvm_SyntheticEthernetPortSettingData.properties.ElementName = adapter_name
-    Msvm_SyntheticEthernetPortSettingData.properties.StaticMacAddress = static_mac
-    if mac:
-      Msvm_SyntheticEthernetPortSettingData.properties.Address = mac
-    result = management_service.AddResourceSettings(Msvm_VirtualSystemSettingData,
-                                                    Msvm_SyntheticEthernetPortSettingData)
-    return VirtualNetworkAdapter(result['ResultingResourceSettings'][-1], self)
+    with self.devices() as devices:
+      devices.add_adapter(static_mac, mac, adapter_name)
+    return devices.adapters[-1]
 
   def is_connected_to_switch(self, virtual_switch: 'VirtualSwitch'):
     """
@@ -367,9 +400,10 @@ class VirtualMachine(MOWrapper):
     :param virtual_switch: virtual switch to check connection
     :return: ``True`` if connected, otherwise ``False``
     """
-    for adapter in self.network_adapters:
-      if virtual_switch == adapter.switch:
-        return True
+    with TraversalSession():
+      for adapter in self.network_adapters:
+        if virtual_switch == adapter.switch:
+          return True
 
   def add_vhd_disk(self, vhd_disk: VHDDisk):
     """
@@ -377,42 +411,9 @@ class VirtualMachine(MOWrapper):
 
     :param vhd_disk: ``VHDDisk`` to add to machine
     """
-    # TODO ability to select controller, disk port, error checking. Make disk bootable by default, etc
-    management_service = VirtualSystemManagementService(self.Scope.query_one('SELECT * FROM Msvm_VirtualSystemManagementService'))
-    Msvm_VirtualSystemSettingData = self.get_child((VirtualSystemSettingDataNode,))
-    Msvm_ResourcePool_SyntheticDiskDrive = self.Scope.query_one(
-      "SELECT * FROM Msvm_ResourcePool WHERE ResourceSubType = 'Microsoft:Hyper-V:Synthetic Disk Drive' AND Primordial = True")
-    Msvm_StorageAllocationSettingData_Path = (
-      RelatedNode(("Msvm_AllocationCapabilities", "Msvm_ElementCapabilities", None, None, None, None, False, None)),
-      RelationshipNode(("Msvm_SettingsDefineCapabilities",), selector=PropertiesSelector(ValueRole=0)),
-      PropertyNode("PartComponent", transformer=ReferenceTransformer())
-    )
-    IdeController_Path = (
-      RelatedNode(("Msvm_ResourceAllocationSettingData",), selector=PropertiesSelector(ResourceType=5,
-                                                                                       ResourceSubType='Microsoft:Hyper-V:Emulated IDE Controller',
-                                                                                       Address=0)),
-    )
-    IdeController = Msvm_VirtualSystemSettingData.get_child(IdeController_Path)
-    Msvm_StorageAllocationSettingData = Msvm_ResourcePool_SyntheticDiskDrive.get_child(
-      Msvm_StorageAllocationSettingData_Path).clone()
-
-    Msvm_StorageAllocationSettingData.properties.Parent = IdeController
-    Msvm_StorageAllocationSettingData.properties.AddressOnParent = 0
-    synthetic_disk_drive = \
-      management_service.AddResourceSettings(Msvm_VirtualSystemSettingData, Msvm_StorageAllocationSettingData)[
-        'ResultingResourceSettings'][-1]
-
-    Msvm_ResourcePool_VirtualHardDisk = self.Scope.query_one(
-      "SELECT * FROM Msvm_ResourcePool WHERE ResourceSubType = 'Microsoft:Hyper-V:Virtual Hard Disk' AND Primordial = True")
-    virtual_hard_disk_path = (
-      RelatedNode(("Msvm_AllocationCapabilities", "Msvm_ElementCapabilities", None, None, None, None, False, None)),
-      RelationshipNode(("Msvm_SettingsDefineCapabilities",), selector=PropertiesSelector(ValueRole=0)),
-      PropertyNode("PartComponent", transformer=ReferenceTransformer())
-    )
-    virtual_hard_disk_data = Msvm_ResourcePool_VirtualHardDisk.get_child(virtual_hard_disk_path).clone()
-    virtual_hard_disk_data.properties.Parent = synthetic_disk_drive
-    virtual_hard_disk_data.properties.HostResource = [vhd_disk.Path]
-    management_service.AddResourceSettings(Msvm_VirtualSystemSettingData, virtual_hard_disk_data)
+    # TODO ability to select controller, disk port. Make disk bootable by default, etc
+    with self.devices() as devices:
+      devices.add_vhd_disk(vhd_disk)
 
   @property
   def network_adapters(self) -> List[VirtualNetworkAdapter]:
@@ -426,7 +427,7 @@ class VirtualMachine(MOWrapper):
       VirtualSystemSettingDataNode,
       RelatedNode(("Msvm_SyntheticEthernetPortSettingData",))
     )
-    for _, Msvm_SyntheticEthernetPortSettingData in self.traverse(port_to_switch_path):
+    for Msvm_SyntheticEthernetPortSettingData in leaves(self.iter_traverse(port_to_switch_path)):
       result.append(VirtualNetworkAdapter(Msvm_SyntheticEthernetPortSettingData, self))
     return result
 
@@ -440,11 +441,12 @@ class VirtualMachine(MOWrapper):
     result = []
     com_ports_path = (
       VirtualSystemSettingDataNode,
-      RelatedNode(("Msvm_ResourceAllocationSettingData",),
-                  selector=PropertiesSelector(ResourceSubtype="Microsoft:Hyper-V:Serial Controller")),
-      RelatedNode(("Msvm_SerialPortSettingData",))
+      ComponentSettingsNode("Msvm_SerialPortSettingData")
     )
-    for _, _, Msvm_SerialPortSettingData in self.traverse(com_ports_path):
+    # serial ports 'InstanceID' ends with port index, sort to keep COM1, COM2 order
+    serial_ports = sorted(leaves(self.iter_traverse(com_ports_path)),
+                          key=lambda port: port.Properties['InstanceID'].Value)
+    for Msvm_SerialPortSettingData in serial_ports:
       result.append(VirtualComPort(Msvm_SerialPortSettingData, self))
     return result
 
@@ -459,16 +461,35 @@ class VirtualMachine(MOWrapper):
     return self.com_ports[port.value]
 
   # internal methods
-  def _wait_for_enabled_state(self, awaitable_state, timeout=DEFAULT_WAIT_OP_TIMEOUT):
-    _start = time.time()
-    while self._enabled_state != awaitable_state and time.time() - _start < timeout:
-      time.sleep(1)
-    return self._enabled_state == awaitable_state
+  @property
+  def events(self) -> ComputerSystemEvents:
+    return ComputerSystemEvents.for_scope(self.Scope)
+
+  def _wait_for_enabled_state(self, awaitable_state, timeout=DEFAULT_WAIT_OP_TIMEOUT, token: CancellationToken = None):
+    enabled_state = self.events.wait_for_state(
+      self.id,
+      lambda _state: _state == awaitable_state,
+      lambda: self._enabled_state,
+      timeout,
+      token=token
+    )
+    return enabled_state == awaitable_state
+
+  def _change_state(self, desired_state: ComputerSystem_RequestStateChange_RequestedState, timeout, deadline,
+                    token: CancellationToken = None):
+    # job and state waits share one deadline, so operation does not take longer than ``timeout``
+    target_enabled_state = desired_state.to_ComputerSystem_EnabledState()
+    try:
+      _wait_invocation(self.RequestStateChange(desired_state, wait=False), deadline, token)
+      changed = self._wait_for_enabled_state(target_enabled_state, _remaining(deadline), token)
+    except WaitTimeoutError:
+      changed = False
+    if not changed:
+      raise Exception("Failed to put machine to '%s' in %s seconds" % (target_enabled_state, timeout))
 
   def _get_shutdown_component(self):
-    shutdown_component_traverse_result = self.traverse((RelatedNode(("Msvm_ShutdownComponent",)),))
-    if shutdown_component_traverse_result:
-      Msvm_ShutdownComponent = shutdown_component_traverse_result[-1][-1]
+    Msvm_ShutdownComponent = self.first_child((RelatedNode(("Msvm_ShutdownComponent",)),))
+    if Msvm_ShutdownComponent is not None:
       operational_status = ShutdownComponent_OperationalStatus.from_code(Msvm_ShutdownComponent.properties['OperationalStatus'][0])
       if operational_status in (ShutdownComponent_OperationalStatus.OK, ShutdownComponent_OperationalStatus.Degraded):
         return ShutdownComponent(Msvm_ShutdownComponent)
@@ -480,73 +501,745 @@ class VirtualMachine(MOWrapper):
     return ComputerSystem_EnabledState.from_code(self.properties['EnabledState'])
 
   # WMI object methods
-  def RequestStateChange(self, RequestedState: ComputerSystem_RequestStateChange_RequestedState, TimeoutPeriod=None):
+  def RequestStateChange(self, RequestedState: ComputerSystem_RequestStateChange_RequestedState, TimeoutPeriod=None,
+                         wait=True, timeout=DEFAULT_JOB_TIMEOUT):
     out_objects = self.invoke("RequestStateChange", RequestedState=RequestedState.value, TimeoutPeriod=TimeoutPeriod)
     return evaluate_invocation_result(
       out_objects,
       ComputerSystem_RequestStateChange_ReturnCodes,
       ComputerSystem_RequestStateChange_ReturnCodes.Completed_with_No_Error,
-      ComputerSystem_RequestStateChange_ReturnCodes.Method_Parameters_Checked_Transition_Started
+      ComputerSystem_RequestStateChange_ReturnCodes.Method_Parameters_Checked_Transition_Started,
+      wait,
+      timeout
     )
 
 
+class PowerOperationResult(object):
+  """
+  Outcome of bulk power operation for one machine. ``elapsed`` is number of seconds from operation start until
+  machine reached target state or failed, ``killed`` is ``True`` if machine was turned off after graceful shutdown.
+  """
+  __slots__ = ('machine', 'machine_id', 'state', 'error', 'elapsed', 'killed')
+
+  def __init__(self, machine: VirtualMachine, machine_id):
+    self.machine = machine
+    self.machine_id = machine_id
+    self.state = None
+    self.error = None
+    self.elapsed = None
+    self.killed = False
+
+  @property
+  def ok(self) -> bool:
+    return self.error is None
+
+  def __repr__(self):
+    return "PowerOperationResult(machine_id=%r, state=%s, error=%r, elapsed=%r, killed=%r)" % (
+      self.machine_id, self.state, self.error, self.elapsed, self.killed)
+
+
+class DeviceBuilder(object):
+  """
+  Collects device changes of virtual machine and applies them with minimal number of calls when context exits::
+
+    with vm.devices() as devices:
+      for disk in data_disks:
+        devices.add_vhd_disk(disk)
+      for _ in range(4):
+        devices.add_adapter(switch=switch)
+
+  Controller slots for drives are resolved from one query of machine resource settings. New adapters and drives are
+  added by first 'AddResourceSettings' call, switch connections and disks that reference them by second one, COM
+  ports are modified by one 'ModifyResourceSettings' call. If any call fails, resources added by previous calls are
+  removed, so machine is left as it was and builder can be committed again. Created devices are matched to requested
+  ones by their properties and are available in ``adapters``, ``drives`` and ``disks`` after commit.
+  """
+  LOG = logging.getLogger('%s.%s' % (__module__, __qualname__))
+  CONTROLLER_SLOTS = {
+    ResourceSubType.EmulatedIDEController.value: 2,
+    ResourceSubType.SyntheticSCSIController.value: 64
+  }
+  DRIVE_SUB_TYPES = (ResourceSubType.SyntheticDiskDrive.value, ResourceSubType.SyntheticDVDDrive.value)
+
+  def __init__(self, machine: 'VirtualMachine'):
+    self.machine = machine
+    self.adapters = []
+    self.drives = []
+    self.disks = []
+    self.committed = False
+    self._new_adapters = []
+    self._connections = []
+    self._vhd_disks = []
+    self._com_ports = {}
+
+  def add_adapter(self, static_mac=False, mac=None, adapter_name="Network Adapter",
+                  switch: 'VirtualSwitch' = None) -> 'DeviceBuilder':
+    """
+    Adds network adapter, see ``VirtualMachine.add_adapter``.
+
+    :param switch: if given, adapter is connected to this switch
+    """
+    self._new_adapters.append((static_mac, mac, adapter_name, switch))
+    return self
+
+  def connect(self, adapter: VirtualNetworkAdapter, switch: 'VirtualSwitch') -> 'DeviceBuilder':
+    """
+    Connects existing adapter to switch, see ``VirtualNetworkAdapter.connect``.
+    """
+    self._connections.append((adapter, switch))
+    return self
+
+  def add_vhd_disk(self, vhd_disk: VHDDisk) -> 'DeviceBuilder':
+    """
+    Adds disk drive with given disk to first free controller slot, IDE controllers are used before SCSI ones.
+    """
+    self._vhd_disks.append(vhd_disk)
+    return self
+
+  def set_com_port(self, port: ComPort, path) -> 'DeviceBuilder':
+    """
+    Sets named pipe path of com-port, see ``VirtualComPort.path``.
+    """
+    self._com_ports[port] = path
+    return self
+
+  def commit(self):
+    """
+    Applies collected changes, waits for every started job.
+    """
+    steps = self.commit_steps()
+    value = error = None
+    while True:
+      try:
+        invocation = steps.throw(error) if error is not None else steps.send(value)
+      except StopIteration:
+        return
+      value = error = None
+      try:
+        value = invocation(wait=True)
+      except Exception as e:
+        error = e
+
+  def commit_steps(self):
+    """
+    Generator that applies collected changes. It yields invocations of management service methods, that must be called
+    with ``wait`` argument and their results sent back, errors of invocations must be thrown into generator. This lets
+    synchronous 'commit' and asynchronous callers share same logic and wait for jobs their own way.
+
+    If any step fails, resources that were already added are removed by one 'RemoveResourceSettings' call and error
+    is raised, so builder can be committed again.
+    """
+    if self.committed:
+      raise ValueError("Devices are already committed")
+    machine = self.machine
+    management_service = machine.services.management_service
+    templates = machine.templates
+    with TraversalSession():
+      Msvm_VirtualSystemSettingData = machine.first_child((VirtualSystemSettingDataNode,))
+      slots = self._free_slots(Msvm_VirtualSystemSettingData) if self._vhd_disks else []
+      com_ports = machine.com_ports if self._com_ports else []
+    if len(slots) < len(self._vhd_disks):
+      raise ValueError("Not enough free controller slots for %s disks, %s available" % (
+        len(self._vhd_disks), len(slots)))
+    slots = slots[:len(self._vhd_disks)]
+
+    added = []
+    try:
+      # adapters and drives do not depend on anything
+      first_stage = []
+      identifiers = []
+      for static_mac, mac, adapter_name, _ in self._new_adapters:
+        identifier = generate_guid()
+        identifiers.append(identifier)
+        adapter_settings = templates.get(ResourceSubType.SyntheticEthernetPort)
+        adapter_settings.properties.VirtualSystemIdentifiers = clr_Array[clr_String]([identifier])
+        adapter_settings.properties.ElementName = adapter_name
+        adapter_settings.properties.StaticMacAddress = static_mac
+        if mac:
+          adapter_settings.properties.Address = mac
+        first_stage.append(adapter_settings)
+      for controller, address in slots:
+        drive_settings = templates.get(ResourceSubType.SyntheticDiskDrive)
+        drive_settings.properties.Parent = controller
+        drive_settings.properties.AddressOnParent = address
+        first_stage.append(drive_settings)
+      adapters = drives = disks = []
+      if first_stage:
+        result = yield partial(management_service.AddResourceSettings, Msvm_VirtualSystemSettingData, *first_stage)
+        created = list(result['ResultingResourceSettings'])
+        added.extend(created)
+        adapters, drives = self._match_first_stage(created, identifiers, slots)
+
+      # connections and disks reference adapters and drives
+      second_stage = []
+      connections = list(self._connections)
+      connections.extend((adapter, new_adapter[3]) for adapter, new_adapter in zip(adapters, self._new_adapters)
+                         if new_adapter[3] is not None)
+      for adapter, switch in connections:
+        connection_settings = templates.get(ResourceSubType.EthernetConnection)
+        connection_settings.properties.Parent = adapter
+        connection_settings.properties.HostResource = [switch]
+        second_stage.append(connection_settings)
+      for drive, vhd_disk in zip(drives, self._vhd_disks):
+        disk_settings = templates.get(ResourceSubType.VirtualHardDisk)
+        disk_settings.properties.Parent = drive
+        disk_settings.properties.HostResource = [vhd_disk.Path]
+        second_stage.append(disk_settings)
+      if second_stage:
+        result = yield partial(management_service.AddResourceSettings, Msvm_VirtualSystemSettingData, *second_stage)
+        created = list(result['ResultingResourceSettings'])
+        added.extend(created)
+        disks = self._match_disks(created, drives)
+
+      changed_ports = []
+      for port, path in self._com_ports.items():
+        com_port = com_ports[port.value]
+        com_port.properties.Connection = [path]
+        changed_ports.append(com_port)
+      if changed_ports:
+        yield partial(management_service.ModifyResourceSettings, *changed_ports)
+    except Exception:
+      if added:
+        self.LOG.debug("Failed to add devices to machine, removing %s added resources", len(added))
+        try:
+          # dependent resources go first
+          yield partial(management_service.RemoveResourceSettings, *reversed(added))
+        except Exception:
+          self.LOG.exception("Failed to remove added resources")
+      raise
+    self.adapters = adapters
+    self.drives = drives
+    self.disks = disks
+    self.committed = True
+
+  def _match_first_stage(self, created, identifiers, slots):
+    """
+    Matches created adapters and drives to requested ones by 'VirtualSystemIdentifiers' and by controller and address.
+    """
+    adapters_by_identifier = {}
+    drives_by_slot = {}
+    for settings in created:
+      if settings.ClassPath.ClassName == VirtualNetworkAdapter.MO_CLS:
+        for identifier in settings.Properties['VirtualSystemIdentifiers'].Value or ():
+          adapters_by_identifier[_normalize_guid(identifier)] = settings
+      else:
+        drives_by_slot[self._drive_slot(settings)] = settings
+    try:
+      adapters = [VirtualNetworkAdapter(adapters_by_identifier[_normalize_guid(identifier)], self.machine)
+                  for identifier in identifiers]
+      drives = [drives_by_slot[(controller.Properties['InstanceID'].Value.upper(), address)]
+                for controller, address in slots]
+    except KeyError as e:
+      raise InvocationException("Resulting resource settings do not contain requested device %s" % e) from None
+    return adapters, drives
+
+  @staticmethod
+  def _match_disks(created, drives):
+    """
+    Matches created disks to drives by 'Parent'.
+    """
+    disks_by_drive = {}
+    for settings in created:
+      if settings.ClassPath.ClassName == 'Msvm_StorageAllocationSettingData':
+        disks_by_drive[path_key(settings.Properties['Parent'].Value, 'InstanceID').upper()] = settings
+    try:
+      return [disks_by_drive[path_key(drive.Path, 'InstanceID').upper()] for drive in drives]
+    except KeyError as e:
+      raise InvocationException("Resulting resource settings do not contain disk of drive %s" % e) from None
+
+  @staticmethod
+  def _drive_slot(settings):
+    return (path_key(settings.Properties['Parent'].Value, 'InstanceID').upper(),
+            int(settings.Properties['AddressOnParent'].Value))
+
+  def _free_slots(self, Msvm_VirtualSystemSettingData):
+    """
+    Returns free (controller, address) pairs, IDE controllers go first.
+    """
+    controllers = []
+    used = set()
+    for settings in leaves(Msvm_VirtualSystemSettingData.iter_traverse(
+        (ComponentSettingsNode("Msvm_ResourceAllocationSettingData"),))):
+      sub_type = settings.Properties['ResourceSubType'].Value
+      if sub_type in self.CONTROLLER_SLOTS:
+        controllers.append(settings)
+      elif sub_type in self.DRIVE_SUB_TYPES:
+        used.add(self._drive_slot(settings))
+    sub_types_order = list(self.CONTROLLER_SLOTS)
+    controllers.sort(key=lambda controller: (sub_types_order.index(controller.Properties['ResourceSubType'].Value),
+                                             str(controller.Properties['Address'].Value)))
+    slots = []
+    for controller in controllers:
+      instance_id = controller.Properties['InstanceID'].Value.upper()
+      for address in range(self.CONTROLLER_SLOTS[controller.Properties['ResourceSubType'].Value]):
+        if (instance_id, address) not in used:
+          slots.append((controller, address))
+    return slots
+
+  def __enter__(self) -> 'DeviceBuilder':
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    if exc_type is None:
+      self.commit()
+
+
+class MachineInventory(object):
+  """
+  Configuration of one virtual machine collected by ``HypervHost.inventory``. Machine and settings are kept as objects
+  returned by class-wide queries, so reading their properties does not cost any additional round trips. Wrappers like
+  ``machine`` and ``adapters`` are bound to object paths and load objects again, use them for operations only.
+  """
+
+  def __init__(self, machine_id: str, machine_object: ManagementObject):
+    self.id = machine_id
+    self.machine_object = machine_object
+    self.system_settings = None
+    self.processor_settings = None
+    self.memory_settings = None
+    self.network_adapters = []
+    self.adapter_connections = {}
+    self.com_ports = []
+    self._machine = None
+
+  @property
+  def name(self) -> str:
+    return self.machine_object.Properties['ElementName'].Value
+
+  @property
+  def enabled_state(self) -> ComputerSystem_EnabledState:
+    return ComputerSystem_EnabledState.from_code(self.machine_object.Properties['EnabledState'].Value)
+
+  @property
+  def machine(self) -> VirtualMachine:
+    if self._machine is None:
+      self._machine = VirtualMachine(self.machine_object)
+    return self._machine
+
+  @property
+  def adapters(self) -> List[VirtualNetworkAdapter]:
+    """
+    Network adapters wrapped as in ``VirtualMachine.network_adapters``.
+    """
+    return [VirtualNetworkAdapter(settings, self.machine) for settings in self.network_adapters]
+
+  def connection(self, adapter) -> ManagementObject:
+    """
+    Returns 'Msvm_EthernetPortAllocationSettingData' that connects given adapter to switch.
+
+    :param adapter: one of ``network_adapters`` or ``adapters``
+    :return: connection settings or ``None`` if adapter is not connected
+    """
+    return self.adapter_connections.get(path_key(adapter.Path, 'InstanceID'))
+
+
+def _normalize_guid(value: str) -> str:
+  return value.strip('{}').upper()
+
+
+def machine_id_from_instance_id(instance_id: str) -> str:
+  """
+  Extracts machine id from 'InstanceID' of settings object. Settings that belong to machine have 'InstanceID' like
+  'Microsoft:<machine id>\\<device id>\\...'.
+
+  :param instance_id: settings 'InstanceID'
+  :return: machine id in upper case
+  """
+  return instance_id.split(':', 1)[-1].split('\\', 1)[0].upper()
+
+
+def _deadline(timeout):
+  return time.monotonic() + timeout if timeout is not None else None
+
+
+def _remaining(deadline):
+  return max(deadline - time.monotonic(), 0) if deadline is not None else None
+
+
+def _wait_invocation(invocation, deadline, token: CancellationToken = None):
+  """
+  Waits for job started by invocation, see 'InvocationFuture', until ``deadline``.
+  """
+  if invocation.job is not None:
+    invocation.job.wait(_remaining(deadline), token)
+  return invocation.result()
+
+
+def _request_error(request):
+  """
+  Returns error of finished state change request or of job started by it, ``None`` if there is no error yet.
+  """
+  if not request.done():
+    return None
+  if request.exception() is not None:
+    return request.exception()
+  invocation = request.result()
+  if invocation is not None and invocation.done():
+    return invocation.exception()
+  return None
+
+
 class HypervHost(object):
   """
   Provides basic interface to get virtual machines, switches, and disk images for host.
   """
+  LOG = logging.getLogger('%s.%s' % (__module__, __qualname__))
+  POWER_BACKOFF = Backoff(initial=0.5, maximum=2, factor=1.5, jitter=0.1)
 
-  def __init__(self, host="."):
-    self.scope = ManagementScope(r"\\{0}\root\virtualization\v2".format(host))
+  MACHINE_CONDITION = 'Caption = "Virtual Machine"'
+  MACHINE_PATH = 'Msvm_ComputerSystem.CreationClassName="Msvm_ComputerSystem",Name="%s"'
+  RESOURCE_SUB_TYPES = {
+    "Msvm_ProcessorSettingData": ResourceSubType.Processor,
+    "Msvm_MemorySettingData": ResourceSubType.Memory
+  }
+
+  def __init__(self, host=".", options: ConnectionOptions = None):
+    self.host = host
+    if options is not None:
+      self.scope = ManagementScope(r"\\{0}\root\virtualization\v2".format(host), options)
+    else:
+      self.scope = ManagementScope(r"\\{0}\root\virtualization\v2".format(host))
+    self.services = ServiceLocator.for_scope(self.scope)
+    self.templates = SettingsTemplates.for_scope(self.scope)
 
   @property
   def switches(self) -> List[VirtualSwitch]:
-    switches = self.scope.query('SELECT * FROM Msvm_VirtualEthernetSwitch')
-    return [VirtualSwitch(_switch) for _switch in switches] if switches else []
-
-  def switch_by_name(self, name) -> VirtualSwitch:
-    switches = self.scope.query('SELECT * FROM Msvm_VirtualEthernetSwitch WHERE ElementName = "%s"' % name)
-    if len(switches) == 0:
-      raise NotFoundException("No switch with name {0}".format(name))
-    if len(switches) > 1:
-      raise TooManyResultsException("Too many switches with name {0}".format(name))
-    return VirtualSwitch(switches[-1])
-
-  def switch_by_id(self, switch_id) -> VirtualSwitch:
-    switches = self.scope.query('SELECT * FROM Msvm_VirtualEthernetSwitch WHERE Name = "%s"' % switch_id)
-    if len(switches) == 0:
-      raise NotFoundException("No switch with id {0}".format(switch_id))
-    if len(switches) > 1:
-      raise TooManyResultsException("Too many switches with id {0}".format(switch_id))
-    return VirtualSwitch(switches[-1])
+    return self.list_switches()
+
+  def list_switches(self, fields: Sequence[str] = None) -> List[Union[VirtualSwitch, ObjectRecord]]:
+    """
+    Returns all virtual switches of host.
+
+    :param fields: if given, only these properties are queried and immutable records are returned instead of switches
+    :return: list of switches or records
+    """
+    return self._select(VirtualSwitch, fields=fields)
+
+  def switch_by_name(self, name, fields: Sequence[str] = None) -> Union[VirtualSwitch, ObjectRecord]:
+    return self._select_one(VirtualSwitch, 'ElementName = "%s"' % name, fields, "switch", "switches", "name %s" % name)
+
+  def switch_by_id(self, switch_id, fields: Sequence[str] = None) -> Union[VirtualSwitch, ObjectRecord]:
+    return self._select_one(VirtualSwitch, 'Name = "%s"' % switch_id, fields, "switch", "switches", "id %s" % switch_id)
 
   @property
   def machines(self) -> List[VirtualMachine]:
-    machines = self.scope.query('SELECT * FROM Msvm_ComputerSystem WHERE Caption = "Virtual Machine"')
-    return [VirtualMachine(_machine) for _machine in machines] if machines else []
-
-  def machine_by_name(self, name) -> VirtualMachine:
-    machines = self.scope.query('SELECT * FROM Msvm_ComputerSystem WHERE Caption = "Virtual Machine" AND ElementName = "%s"' % name)
-    if len(machines) == 0:
-      raise NotFoundException("No machine with name {0}".format(name))
-    if len(machines) > 1:
-      raise TooManyResultsException("Too many machines with name {0}".format(name))
-    return VirtualMachine(machines[-1])
-
-  def machine_by_id(self, machine_id) -> VirtualMachine:
-    machines = self.scope.query('SELECT * FROM Msvm_ComputerSystem WHERE Caption = "Virtual Machine" AND Name = "%s"' % machine_id)
-    if len(machines) == 0:
-      raise NotFoundException("No machine with id {0}".format(machine_id))
-    if len(machines) > 1:
-      raise TooManyResultsException("Too many machines with id {0}".format(machine_id))
-    return VirtualMachine(machines[-1])
+    if self.state_table.active:
+      factory = ObjectFactory.for_scope(self.scope)
+      return [
+        VirtualMachine(factory.get(self.MACHINE_PATH % entry.id))
+        for entry in self.state_table.entries
+      ]
+    return self.list_machines()
+
+  @property
+  def state_table(self) -> MachineStateTable:
+    return MachineStateTable.for_scope(self.scope)
+
+  def watch(self, resync_interval=MachineStateTable.DEFAULT_RESYNC_INTERVAL) -> MachineStateTable:
+    """
+    Starts host-wide live state table of virtual machines. Table is fed by one event subscription for creation,
+    modification and deletion of machines and is resynced by one bulk query every ``resync_interval`` seconds.
+    While table is active ``machines`` and ``VirtualMachine.state`` are answered from table.
+
+    :param resync_interval: seconds between bulk resyncs
+    :return: state table
+    """
+    self.state_table.start(resync_interval)
+    return self.state_table
+
+  def unwatch(self):
+    """
+    Stops host-wide live state table.
+    """
+    self.state_table.stop()
+
+  def machine_states(self) -> List[MachineStateEntry]:
+    """
+    Returns known states of all virtual machines, list is empty if host is not watched.
+
+    :return: list of state entries
+    """
+    return self.state_table.entries
+
+  def list_machines(self, fields: Sequence[str] = None) -> List[Union[VirtualMachine, ObjectRecord]]:
+    """
+    Returns all virtual machines of host.
+
+    :param fields: if given, only these properties are queried and immutable records are returned instead of machines
+    :return: list of machines or records
+    """
+    return self._select(VirtualMachine, self.MACHINE_CONDITION, fields)
+
+  def machine_by_name(self, name, fields: Sequence[str] = None) -> Union[VirtualMachine, ObjectRecord]:
+    return self._select_one(VirtualMachine, '%s AND ElementName = "%s"' % (self.MACHINE_CONDITION, name), fields,
+                            "machine", "machines", "name %s" % name)
+
+  def machine_by_id(self, machine_id, fields: Sequence[str] = None) -> Union[VirtualMachine, ObjectRecord]:
+    return self._select_one(VirtualMachine, '%s AND Name = "%s"' % (self.MACHINE_CONDITION, machine_id), fields,
+                            "machine", "machines", "id %s" % machine_id)
+
+  def start_many(self, machines: Sequence[VirtualMachine], concurrency=DEFAULT_POWER_CONCURRENCY,
+                 timeout=DEFAULT_WAIT_OP_TIMEOUT, token: CancellationToken = None) -> Dict[str, PowerOperationResult]:
+    """
+    Starts given machines. State change requests are sent by at most ``concurrency`` threads, states of all machines
+    are tracked by one query per tick.
+
+    :param machines: machines to start
+    :param concurrency: max number of simultaneous requests
+    :param timeout: seconds to wait for each machine to reach running state, counted from sending of its request
+    :param token: cancellation token, machines that did not reach target state get 'CancelledError'
+    :return: dict of machine id and outcome, in order of given machines
+    :raises ValueError: if same machine is given more than once
+    """
+    return self._power_many(machines, ComputerSystem_RequestStateChange_RequestedState.Running, concurrency, timeout,
+                            token)
+
+  def save_many(self, machines: Sequence[VirtualMachine], concurrency=DEFAULT_POWER_CONCURRENCY,
+                timeout=DEFAULT_WAIT_OP_TIMEOUT, token: CancellationToken = None) -> Dict[str, PowerOperationResult]:
+    """
+    Saves given machines, see ``start_many``.
+    """
+    return self._power_many(machines, ComputerSystem_RequestStateChange_RequestedState.Saved, concurrency, timeout,
+                            token)
+
+  def stop_many(self, machines: Sequence[VirtualMachine], concurrency=DEFAULT_POWER_CONCURRENCY, force=False,
+                hard=False, timeout=DEFAULT_WAIT_OP_TIMEOUT,
+                token: CancellationToken = None) -> Dict[str, PowerOperationResult]:
+    """
+    Stops given machines like ``VirtualMachine.stop``, machines that were not stopped gracefully in ``timeout`` seconds
+    are killed and waited for ``timeout`` seconds more.
+
+    :param machines: machines to stop
+    :param concurrency: max number of simultaneous requests
+    :param force: indicates if we need to wait for user programs completion, ignored if *force* is *True*
+    :param hard: indicates if we need to perform turn off(power off)
+    :param timeout: seconds to wait for each phase, counted from sending of request of machine
+    :param token: cancellation token
+    :return: dict of machine id and outcome, in order of given machines
+    """
+    return self._power_many(machines, ComputerSystem_RequestStateChange_RequestedState.Off, concurrency, timeout,
+                            token, graceful=not hard, force=force)
+
+  def _power_many(self, machines, requested_state, concurrency, timeout, token, graceful=False, force=False):
+    target_state = requested_state.to_ComputerSystem_EnabledState()
+    started = time.monotonic()
+    results = {}
+    for machine in machines:
+      # key is taken from path, reading 'Name' property would load whole object
+      machine_id = (path_key(machine.Path, 'Name') or machine.id).upper()
+      if machine_id in results:
+        raise ValueError("Machine with id %s is given more than once" % machine_id)
+      results[machine_id] = PowerOperationResult(machine, machine_id)
+    pending = {}
+    states = self._enabled_states(results.keys())
+    for machine_id, result in results.items():
+      state = states.get(machine_id)
+      if state is None:
+        result.error = NotFoundException("Machine with id %s not found" % machine_id)
+        result.elapsed = 0
+      elif state == target_state:
+        result.state = state
+        result.elapsed = 0
+      else:
+        pending[machine_id] = result
+    if not pending:
+      return results
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+      requests = {}
+      # deadline of machine starts when its request is sent, not when it is queued
+      dispatched = {}
+      killing = set()
+
+      def dispatch(machine_id, _graceful, _force):
+        result = pending[machine_id]
+
+        def request():
+          dispatched[machine_id] = time.monotonic()
+          return self._request_power(result, requested_state, _graceful, _force)
+
+        requests[machine_id] = executor.submit(request)
+
+      def poll():
+        self._poll_power_results(pending, requests, target_state, started)
+        if timeout is None:
+          return len(pending)
+        now = time.monotonic()
+        for machine_id in list(pending):
+          dispatched_at = dispatched.get(machine_id)
+          if dispatched_at is None or now - dispatched_at < timeout:
+            continue
+          if graceful and machine_id not in killing:
+            self.LOG.debug("Failed to stop machine '%s' gracefully, killing...", machine_id)
+            killing.add(machine_id)
+            del dispatched[machine_id]
+            dispatch(machine_id, False, False)
+          else:
+            result = pending.pop(machine_id)
+            result.error = Exception("Failed to put machine to '%s' in %s seconds" % (target_state, timeout))
+            result.elapsed = now - started
+        return len(pending)
+
+      for machine_id in list(pending):
+        dispatch(machine_id, graceful, force)
+      try:
+        wait_until(poll, lambda remaining: remaining == 0, None, self.POWER_BACKOFF, token,
+                   name="%s of %s machines" % (requested_state.name, len(requests)))
+      except CancelledError as e:
+        for request in requests.values():
+          request.cancel()
+        for result in pending.values():
+          result.error = e
+          result.elapsed = time.monotonic() - started
+    return results
+
+  @staticmethod
+  def _request_power(result: PowerOperationResult, requested_state, graceful, force):
+    if graceful:
+      shutdown_component = result.machine._get_shutdown_component()
+      if shutdown_component:
+        return shutdown_component.InitiateShutdown(force, "hvapi shutdown", wait=False)
+    if requested_state == ComputerSystem_RequestStateChange_RequestedState.Off:
+      result.killed = True
+    return result.machine.RequestStateChange(requested_state, wait=False)
+
+  def _poll_power_results(self, pending, requests, target_state, started):
+    states = self._enabled_states(pending.keys())
+    now = time.monotonic()
+    for machine_id in list(pending):
+      result = pending[machine_id]
+      state = states.get(machine_id)
+      error = _request_error(requests[machine_id])
+      if state is None:
+        error = NotFoundException("Machine with id %s not found" % machine_id)
+      if state == target_state or error is not None:
+        result.state = state
+        result.error = error if state != target_state else None
+        result.elapsed = now - started
+        del pending[machine_id]
+
+  def _enabled_states(self, machine_ids) -> Dict[str, ComputerSystem_EnabledState]:
+    # one query for all machines of host is cheaper than condition with term per machine, filtered here
+    machine_ids = set(machine_ids)
+    if not machine_ids:
+      return {}
+    states = {}
+    for record in self.scope.iter_records(VirtualMachine.MO_CLS, ('Name', 'EnabledState'), self.MACHINE_CONDITION):
+      machine_id = record.Name.upper()
+      if machine_id in machine_ids:
+        states[machine_id] = ComputerSystem_EnabledState.from_code(record.EnabledState)
+    return states
+
+  def inventory(self) -> Dict[str, MachineInventory]:
+    """
+    Collects configuration of all virtual machines with fixed number of queries, one per settings class, regardless
+    of number of machines. Only realized configuration is collected: resource settings are joined to realized
+    'Msvm_VirtualSystemSettingData' by 'InstanceID' prefix, settings of snapshots and planned machines are skipped.
+
+    :return: dict of machine id and its inventory
+    """
+    result = {}
+    for machine in self.scope.iter_query(select_query(VirtualMachine.MO_CLS, where=self.MACHINE_CONDITION)):
+      machine_id = machine.Properties['Name'].Value.upper()
+      result[machine_id] = MachineInventory(machine_id, machine)
+
+    # resource settings 'InstanceID' is 'InstanceID' of owning system settings followed by device components
+    configurations = {}
+    for settings in self.scope.iter_query(select_query('Msvm_VirtualSystemSettingData',
+                                                       where="VirtualSystemType = 'Microsoft:Hyper-V:System:Realized'")):
+      instance_id = settings.Properties['InstanceID'].Value
+      inventory = result.get(machine_id_from_instance_id(instance_id))
+      if inventory is not None:
+        inventory.system_settings = settings
+        configurations[instance_id.upper()] = inventory
+
+    def _settings(class_name):
+      for settings in self.scope.iter_query(select_query(class_name)):
+        inventory = configurations.get(settings.Properties['InstanceID'].Value.split('\\', 1)[0].upper())
+        if inventory is not None:
+          yield inventory, settings
+
+    for inventory, settings in _settings('Msvm_ProcessorSettingData'):
+      if inventory.processor_settings is not None:
+        raise TooManyResultsException("Too many processor settings of machine %s" % inventory.id)
+      inventory.processor_settings = settings
+    for inventory, settings in _settings('Msvm_MemorySettingData'):
+      if inventory.memory_settings is not None:
+        raise TooManyResultsException("Too many memory settings of machine %s" % inventory.id)
+      inventory.memory_settings = settings
+    for inventory, settings in _settings('Msvm_SyntheticEthernetPortSettingData'):
+      inventory.network_adapters.append(settings)
+    for inventory, settings in _settings('Msvm_EthernetPortAllocationSettingData'):
+      # connection 'InstanceID' is adapter 'InstanceID' with one more component
+      adapter_instance_id = settings.Properties['InstanceID'].Value.rpartition('\\')[0]
+      inventory.adapter_connections[adapter_instance_id] = settings
+    for inventory, settings in _settings('Msvm_SerialPortSettingData'):
+      inventory.com_ports.append(settings)
+    return result
+
+  def _select(self, wrapper_cls, where=None, fields: Sequence[str] = None, limit=None) -> list:
+    if fields:
+      objects = self.scope.iter_records(wrapper_cls.MO_CLS, fields, where)
+    else:
+      objects = (wrapper_cls(_object) for _object in self.scope.iter_query(select_query(wrapper_cls.MO_CLS, where=where)))
+    with closing(objects):
+      return list(islice(objects, limit))
+
+  def _select_one(self, wrapper_cls, where, fields, kind, kind_plural, key):
+    result = self._select(wrapper_cls, where, fields, limit=2)
+    if len(result) == 0:
+      raise NotFoundException("No {0} with {1}".format(kind, key))
+    if len(result) > 1:
+      raise TooManyResultsException("Too many {0} with {1}".format(kind_plural, key))
+    return result[-1]
 
   def create_machine(self, name, properties_group: Dict[str, Dict[str, Any]] = None,
-                     machine_generation: VirtualMachineGeneration = VirtualMachineGeneration.GEN1) -> VirtualMachine:
-    management_service = VirtualSystemManagementService(self.scope.query_one('SELECT * FROM Msvm_VirtualSystemManagementService'))
-    Msvm_VirtualSystemSettingData = self.scope.cls_instance("Msvm_VirtualSystemSettingData")
-    Msvm_VirtualSystemSettingData.properties.ElementName = name
-    Msvm_VirtualSystemSettingData.properties.VirtualSystemSubType = machine_generation.value
-    result = management_service.DefineSystem(SystemSettings=Msvm_VirtualSystemSettingData)
-    vm = VirtualMachine(result['ResultingSystem'])
-    vm.apply_properties_group(properties_group)
-    return vm
+                     machine_generation: VirtualMachineGeneration = VirtualMachineGeneration.GEN1,
+                     adapters: Sequence[Dict[str, Any]] = None) -> VirtualMachine:
+    """
+    Creates virtual machine with one 'DefineSystem' invocation. Processor and memory settings from
+    ``properties_group`` and network adapters are built from default settings of primordial pools and passed to
+    'DefineSystem' as embedded resource settings, so configured machine is created by one job.
+
+    Switch connections, drives and disks reference devices that exist only after machine is defined, so they must be
+    added afterwards, see ``VirtualNetworkAdapter.connect`` and ``VirtualMachine.add_vhd_disk``.
+
+    :param name: machine name
+    :param properties_group: dict of classes and their properties, see ``VirtualMachine.apply_properties_group``
+    :param machine_generation: machine generation
+    :param adapters: properties of network adapters to create, e.g. ``[{'ElementName': 'eth0'}]``
+    :return: created machine
+    """
+    properties_group = dict(properties_group or {})
+    system_settings = self.scope.cls_instance("Msvm_VirtualSystemSettingData")
+    snapshot = system_settings.snapshot()
+    snapshot.update({'ElementName': name, 'VirtualSystemSubType': machine_generation.value})
+    snapshot.update(properties_group.pop("Msvm_VirtualSystemSettingData", {}))
+    snapshot.flush()
+
+    resource_settings = []
+    for class_name, properties in properties_group.items():
+      if class_name not in self.RESOURCE_SUB_TYPES:
+        raise ValueError("Settings class '%s' can not be passed to 'DefineSystem'" % class_name)
+      resource_settings.append(self._resource_settings(self.RESOURCE_SUB_TYPES[class_name], properties))
+    for adapter_properties in adapters or ():
+      properties = {
+        'VirtualSystemIdentifiers': clr_Array[clr_String]([generate_guid()]),
+        'ElementName': "Network Adapter",
+        'StaticMacAddress': False
+      }
+      properties.update(adapter_properties)
+      resource_settings.append(self._resource_settings(ResourceSubType.SyntheticEthernetPort, properties))
+
+    result = self.services.management_service.DefineSystem(
+      SystemSettings=system_settings,
+      ResourceSettings=resource_settings
+    )
+    return VirtualMachine(result['ResultingSystem'])
+
+  def _resource_settings(self, resource_sub_type: ResourceSubType, properties: Dict[str, Any]):
+    settings = self.templates.get(resource_sub_type)
+    snapshot = settings.snapshot()
+    snapshot.update(properties)
+    snapshot.flush()
+    return settings
@@ -0,0 +1,262 @@
+# The MIT License
+#
+# Copyright (c) 2017 Eugene Chekanskiy, echekanskiy@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import asyncio
+import logging
+import random
+import threading
+import time
+from concurrent.futures import CancelledError
+from typing import Awaitable, Callable, Iterator, TypeVar, Union
+
+LOG = logging.getLogger(__name__)
+T = TypeVar('T')
+
+
+class WaitTimeoutError(TimeoutError):
+  """
+  Raised when wait did not converge before its deadline. ``value`` is last polled value.
+  """
+
+  def __init__(self, name, timeout, value):
+    super().__init__("Wait '%s' did not converge in %s seconds, last value '%s'" % (name, timeout, value))
+    self.value = value
+
+
+class Backoff(object):
+  """
+  Delays between polls. Delay starts at ``initial`` and is multiplied by ``factor`` after each poll up to ``maximum``.
+  With ``jitter`` every delay is randomly reduced by up to this fraction, so many waiters do not poll simultaneously.
+  """
+
+  def __init__(self, initial=0.1, maximum=2, factor=2, jitter=0.0):
+    if initial <= 0 or maximum < initial or factor < 1 or not 0 <= jitter < 1:
+      raise ValueError("Invalid backoff parameters")
+    self.initial = initial
+    self.maximum = maximum
+    self.factor = factor
+    self.jitter = jitter
+
+  def delays(self) -> Iterator[float]:
+    delay = self.initial
+    while True:
+      if self.jitter:
+        yield delay * (1 - self.jitter * random.random())
+      else:
+        yield delay
+      delay = min(delay * self.factor, self.maximum)
+
+  def __repr__(self):
+    return "Backoff(initial=%r, maximum=%r, factor=%r, jitter=%r)" % (
+      self.initial, self.maximum, self.factor, self.jitter)
+
+
+DEFAULT_BACKOFF = Backoff(initial=0.1, maximum=2, factor=1.5, jitter=0.1)
+
+
+class CancellationToken(object):
+  """
+  Cancels all waits it is passed to. Waits sleeping at the moment of cancellation are woken immediately.
+  """
+
+  def __init__(self):
+    self._cancelled = False
+    self._events = set()
+    self._lock = threading.Lock()
+
+  @property
+  def cancelled(self) -> bool:
+    return self._cancelled
+
+  def cancel(self):
+    with self._lock:
+      self._cancelled = True
+      events = list(self._events)
+    for event in events:
+      event.set()
+
+  def raise_if_cancelled(self):
+    if self._cancelled:
+      raise CancelledError()
+
+  def _register(self, event: Union[threading.Event, '_LoopWakeup']):
+    with self._lock:
+      self._events.add(event)
+      if self._cancelled:
+        event.set()
+
+  def _unregister(self, event: Union[threading.Event, '_LoopWakeup']):
+    with self._lock:
+      self._events.discard(event)
+
+
+class _LoopWakeup(object):
+  """
+  Sets asyncio event from any thread, so 'CancellationToken' wakes asyncio waits like threading ones.
+  """
+  __slots__ = ('loop', 'event')
+
+  def __init__(self, loop: asyncio.AbstractEventLoop, event: asyncio.Event):
+    self.loop = loop
+    self.event = event
+
+  def set(self):
+    try:
+      self.loop.call_soon_threadsafe(self.event.set)
+    except RuntimeError:
+      # loop is closed, nobody waits anymore
+      pass
+
+
+class WaitStats(object):
+  """
+  Instrumentation of one finished wait, passed to listeners registered by 'add_listener'.
+  """
+  __slots__ = ('name', 'polls', 'elapsed', 'converged', 'cancelled')
+
+  def __init__(self, name, polls, elapsed, converged, cancelled):
+    self.name = name
+    self.polls = polls
+    self.elapsed = elapsed
+    self.converged = converged
+    self.cancelled = cancelled
+
+  def __repr__(self):
+    return "WaitStats(name=%r, polls=%r, elapsed=%r, converged=%r, cancelled=%r)" % (
+      self.name, self.polls, self.elapsed, self.converged, self.cancelled)
+
+
+_listeners = []
+
+
+def add_listener(listener: Callable[[WaitStats], None]):
+  _listeners.append(listener)
+
+
+def remove_listener(listener: Callable[[WaitStats], None]):
+  _listeners.remove(listener)
+
+
+def _emit(stats: WaitStats):
+  LOG.debug("%s", stats)
+  for listener in list(_listeners):
+    try:
+      listener(stats)
+    except Exception:
+      LOG.exception("Wait listener failed")
+
+
+def wait_until(poll: Callable[[], T], accept: Callable[[T], bool], timeout=None, backoff: Backoff = None,
+               token: CancellationToken = None, wakeup: threading.Event = None, name="wait") -> T:
+  """
+  Polls value until it is accepted. Delays between polls are taken from ``backoff``, setting ``wakeup`` event polls
+  immediately and restarts backoff, e.g. when change notification arrives.
+
+  :param poll: returns actual value
+  :param accept: returns ``True`` if value is what we are waiting for
+  :param timeout: seconds to wait, ``None`` to wait forever
+  :param backoff: delays between polls, 'DEFAULT_BACKOFF' if not given
+  :param token: cancellation token, 'CancelledError' is raised when it is cancelled
+  :param wakeup: event that triggers immediate poll
+  :param name: name of wait for instrumentation
+  :return: accepted value
+  """
+  backoff = backoff or DEFAULT_BACKOFF
+  wakeup = wakeup or threading.Event()
+  if token is not None:
+    token._register(wakeup)
+  started = time.monotonic()
+  deadline = started + timeout if timeout is not None else None
+  polls = 0
+  converged = False
+  cancelled = False
+  try:
+    delays = backoff.delays()
+    while True:
+      if token is not None and token.cancelled:
+        cancelled = True
+        raise CancelledError()
+      wakeup.clear()
+      value = poll()
+      polls += 1
+      if accept(value):
+        converged = True
+        return value
+      delay = next(delays)
+      if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          raise WaitTimeoutError(name, timeout, value)
+        delay = min(delay, remaining)
+      if wakeup.wait(delay):
+        delays = backoff.delays()
+  finally:
+    if token is not None:
+      token._unregister(wakeup)
+    _emit(WaitStats(name, polls, time.monotonic() - started, converged, cancelled))
+
+
+async def wait_until_async(poll: Callable[[], Awaitable[T]], accept: Callable[[T], bool], timeout=None,
+                           backoff: Backoff = None, token: CancellationToken = None, wakeup: asyncio.Event = None,
+                           name="wait") -> T:
+  """
+  Asyncio version of 'wait_until', delays are done by asyncio, so waiting does not occupy any thread. ``poll`` is
+  coroutine function. Cancellation of awaiting task cancels wait as well as ``token``.
+  """
+  backoff = backoff or DEFAULT_BACKOFF
+  wakeup = wakeup or asyncio.Event()
+  token_wakeup = _LoopWakeup(asyncio.get_running_loop(), wakeup)
+  if token is not None:
+    token._register(token_wakeup)
+  started = time.monotonic()
+  deadline = started + timeout if timeout is not None else None
+  polls = 0
+  converged = False
+  cancelled = False
+  try:
+    delays = backoff.delays()
+    while True:
+      if token is not None and token.cancelled:
+        raise CancelledError()
+      wakeup.clear()
+      value = await poll()
+      polls += 1
+      if accept(value):
+        converged = True
+        return value
+      delay = next(delays)
+      if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          raise WaitTimeoutError(name, timeout, value)
+        delay = min(delay, remaining)
+      try:
+        await asyncio.wait_for(wakeup.wait(), delay)
+        delays = backoff.delays()
+      except asyncio.TimeoutError:
+        pass
+  except (CancelledError, asyncio.CancelledError):
+    cancelled = True
+    raise
+  finally:
+    if token is not None:
+      token._unregister(token_wakeup)
+    _emit(WaitStats(name, polls, time.monotonic() - started, converged, cancelled))